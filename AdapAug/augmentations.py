@@ -1,63 +1,116 @@
 # code in this file is adpated from rpmcruz/autoaugment
 # https://github.com/rpmcruz/autoaugment/blob/master/transformations.py
-import random
+import functools
+import math
 
-import PIL, PIL.ImageOps, PIL.ImageEnhance, PIL.ImageDraw
+import PIL, PIL.ImageOps, PIL.ImageEnhance, PIL.ImageDraw, PIL.ImageFilter
 import numpy as np
 import torch
 from torchvision.transforms.transforms import Compose
 
+from AdapAug import rng
+
 random_mirror = False
+fuse_affine = True    # warp consecutive geometric ops of a subpolicy once (apply_augments)
+fuse_lut = True       # apply consecutive pointwise ops of a subpolicy as one lookup table (apply_augments)
 
 def ShearX(img, v):  # [-0.3, 0.3]
+    return img.transform(img.size, PIL.Image.AFFINE, ShearX_matrix(img.size, v))
+
+
+def ShearY(img, v):  # [-0.3, 0.3]
+    return img.transform(img.size, PIL.Image.AFFINE, ShearY_matrix(img.size, v))
+
+
+def TranslateX(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+    return img.transform(img.size, PIL.Image.AFFINE, TranslateX_matrix(img.size, v))
+
+
+def TranslateY(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+    return img.transform(img.size, PIL.Image.AFFINE, TranslateY_matrix(img.size, v))
+
+
+def TranslateXAbs(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+    return img.transform(img.size, PIL.Image.AFFINE, TranslateXAbs_matrix(img.size, v))
+
+
+def TranslateYAbs(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+    return img.transform(img.size, PIL.Image.AFFINE, TranslateYAbs_matrix(img.size, v))
+
+
+def Rotate(img, v):  # [-30, 30]
+    # same result as img.rotate(v)
+    return img.transform(img.size, PIL.Image.AFFINE, Rotate_matrix(img.size, v))
+
+
+# affine matrices (output -> input pixel coordinates, PIL convention) of the geometric ops.
+# random draws (mirror / sign) happen here, so a matrix is one resolved op.
+def ShearX_matrix(size, v):
     assert -0.3 <= v <= 0.3, "v=%f" % v
-    if random_mirror and random.random() > 0.5:
+    if random_mirror and rng.random() > 0.5:
         v = -v
-    return img.transform(img.size, PIL.Image.AFFINE, (1, v, 0, 0, 1, 0))
+    return (1, v, 0, 0, 1, 0)
 
 
-def ShearY(img, v):  # [-0.3, 0.3]
+def ShearY_matrix(size, v):
     assert -0.3 <= v <= 0.3, "v=%f" % v
-    if random_mirror and random.random() > 0.5:
+    if random_mirror and rng.random() > 0.5:
         v = -v
-    return img.transform(img.size, PIL.Image.AFFINE, (1, 0, 0, v, 1, 0))
+    return (1, 0, 0, v, 1, 0)
 
 
-def TranslateX(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+def TranslateX_matrix(size, v):
     assert -0.45 <= v <= 0.45, "v=%f" % v
-    if random_mirror and random.random() > 0.5:
+    if random_mirror and rng.random() > 0.5:
         v = -v
-    v = v * img.size[0]
-    return img.transform(img.size, PIL.Image.AFFINE, (1, 0, v, 0, 1, 0))
+    v = v * size[0]
+    return (1, 0, v, 0, 1, 0)
 
 
-def TranslateY(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+def TranslateY_matrix(size, v):
     assert -0.45 <= v <= 0.45, "v=%f" % v
-    if random_mirror and random.random() > 0.5:
+    if random_mirror and rng.random() > 0.5:
         v = -v
-    v = v * img.size[1]
-    return img.transform(img.size, PIL.Image.AFFINE, (1, 0, 0, 0, 1, v))
+    v = v * size[1]
+    return (1, 0, 0, 0, 1, v)
 
 
-def TranslateXAbs(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+def TranslateXAbs_matrix(size, v):
     assert 0 <= v <= 10, "v=%f" % v
-    if random.random() > 0.5:
+    if rng.random() > 0.5:
         v = -v
-    return img.transform(img.size, PIL.Image.AFFINE, (1, 0, v, 0, 1, 0))
+    return (1, 0, v, 0, 1, 0)
 
 
-def TranslateYAbs(img, v):  # [-150, 150] => percentage: [-0.45, 0.45]
+def TranslateYAbs_matrix(size, v):
     assert 0 <= v <= 10, "v=%f" % v
-    if random.random() > 0.5:
+    if rng.random() > 0.5:
         v = -v
-    return img.transform(img.size, PIL.Image.AFFINE, (1, 0, 0, 0, 1, v))
+    return (1, 0, 0, 0, 1, v)
 
 
-def Rotate(img, v):  # [-30, 30]
+def Rotate_matrix(size, v):
     assert -30 <= v <= 30, "v=%f" % v
-    if random_mirror and random.random() > 0.5:
+    if random_mirror and rng.random() > 0.5:
         v = -v
-    return img.rotate(v)
+    return rotate_matrix(size[0], size[1], v)
+
+
+def rotate_matrix(w, h, angle):
+    # same matrix as PIL.Image.rotate(angle) about the image center
+    angle = -math.radians(angle % 360.0)
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    cx, cy = w / 2, h / 2
+    return (cos, sin, cos * -cx + sin * -cy + cx,
+            -sin, cos, -sin * -cx + cos * -cy + cy)
+
+
+def compose_affine(m1, m2):
+    # matrix of warping with m1 and then with m2: output p reads the input at m1(m2(p))
+    a, b, c, d, e, f = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a * a2 + b * d2, a * b2 + b * e2, a * c2 + b * f2 + c,
+            d * a2 + e * d2, d * b2 + e * e2, d * c2 + e * f2 + f)
 
 
 def AutoContrast(img, v):
@@ -133,8 +186,8 @@ def CutoutAbs(img, v):  # [0, 60] => percentage: [0, 0.2]
     if v < 0:
         return img
     w, h = img.size
-    x0 = np.random.uniform(w)
-    y0 = np.random.uniform(h)
+    x0 = rng.np_uniform(w)
+    y0 = rng.np_uniform(h)
 
     x0 = int(max(0, x0 - v / 2.))
     y0 = int(max(0, y0 - v / 2.))
@@ -199,6 +252,196 @@ def apply_augment(img, name, level):
     return augment_fn(img.copy(), level * (high - low) + low)
 
 
+affine_dict = {
+    'ShearX': ShearX_matrix,
+    'ShearY': ShearY_matrix,
+    'TranslateX': TranslateX_matrix,
+    'TranslateY': TranslateY_matrix,
+    'TranslateXAbs': TranslateXAbs_matrix,
+    'TranslateYAbs': TranslateYAbs_matrix,
+    'Rotate': Rotate_matrix,
+}
+
+
+# lookup tables [256] (uint8) of the pointwise ops. Contrast depends on the image mean,
+# so its table is [256 (mean), 256].
+_ix = np.arange(256)
+
+
+def _blend_lut(degenerate, alpha):
+    # PIL.Image.blend(degenerate, img, alpha): computed in C float, truncated and clipped
+    in1 = np.asarray(degenerate, dtype=np.float32)
+    out = in1 + np.float32(alpha) * (_ix.astype(np.float32) - in1)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def Invert_lut(v):
+    return (255 - _ix).astype(np.uint8)
+
+
+def Solarize_lut(v):
+    assert 0 <= v <= 256, "v=%f" % v
+    return np.where(_ix < v, _ix, 255 - _ix).astype(np.uint8)
+
+
+def Posterize_lut(v):
+    assert 4 <= v <= 8, "v=%f" % v
+    return (_ix & ~(2 ** (8 - int(v)) - 1)).astype(np.uint8)
+
+
+def Posterize2_lut(v):
+    assert 0 <= v <= 4, "v=%f" % v
+    return (_ix & ~(2 ** (8 - int(v)) - 1)).astype(np.uint8)
+
+
+def Brightness_lut(v):
+    assert 0.1 <= v <= 1.9, "v=%f" % v
+    return _blend_lut(0, v)
+
+
+def Contrast_lut(v):
+    assert 0.1 <= v <= 1.9, "v=%f" % v
+    return _blend_lut(_ix.reshape(-1, 1), v)
+
+
+lut_dict = {
+    'Invert': Invert_lut,
+    'Solarize': Solarize_lut,
+    'Posterize': Posterize_lut,
+    'Posterize2': Posterize2_lut,
+    'Brightness': Brightness_lut,
+    'Contrast': Contrast_lut,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_lut(name, level):
+    _, low, high = get_augment(name)
+    lut = lut_dict[name](level * (high - low) + low)
+    lut.flags.writeable = False     # shared by every caller
+    return lut
+
+
+# the controller only emits 10 magnitude bins (level = m_id / 10 + .1)
+for _name in lut_dict:
+    for _m in range(10):
+        get_lut(_name, _m / 10. + .1)
+
+
+def contrast_mean(img):
+    # same as int(ImageStat.Stat(img.convert("L")).mean[0] + 0.5) in ImageEnhance.Contrast
+    return int(np.asarray(img.convert("L")).mean() + 0.5)
+
+
+def apply_lut(img, lut):
+    if img.size[0] * img.size[1] <= 64 * 64:
+        # img.point converts the table in python (~80us); for CIFAR-sized images one
+        # np.take pass is cheaper
+        return PIL.Image.fromarray(np.take(lut, np.asarray(img)))
+    return img.point(lut.tolist() * len(img.getbands()))
+
+
+class EnhanceContext(object):
+    """
+    Degenerate images of the ImageEnhance ops (Color, Contrast, Brightness, Sharpness)
+    for one source image, each computed on first use. Pass the same context to every view
+    of a sample: ops applied to the untouched source image blend against the cached copy.
+    """
+    def __init__(self, img):
+        self.img = img
+        self._degenerate = {}
+        self._mean = None
+
+    def mean(self):
+        if self._mean is None:
+            self._mean = contrast_mean(self.img)
+        return self._mean
+
+    def degenerate(self, name):
+        if name not in self._degenerate:
+            img = self.img
+            if name == 'Color':
+                degenerate = img.convert('L').convert(img.mode)
+            elif name == 'Contrast':
+                degenerate = PIL.Image.new('L', img.size, self.mean()).convert(img.mode)
+            elif name == 'Brightness':
+                degenerate = PIL.Image.new(img.mode, img.size, 0)
+            elif name == 'Sharpness':
+                degenerate = img.filter(PIL.ImageFilter.SMOOTH)
+            else:
+                raise ValueError('no degenerate image for %s' % name)
+            self._degenerate[name] = degenerate
+        return self._degenerate[name]
+
+    def enhance(self, name, v):
+        # same as PIL.ImageEnhance.<name>(self.img).enhance(v)
+        assert 0.1 <= v <= 1.9, "v=%f" % v
+        return PIL.Image.blend(self.degenerate(name), self.img, v)
+
+
+enhance_ops = ('Color', 'Contrast', 'Brightness', 'Sharpness')
+
+
+def apply_augments(img, ops, ctx=None):
+    """
+    Apply a resolved subpolicy (probability gates already drawn).
+    ops: list of (name, level)
+    ctx: (EnhanceContext) of the source image, optional
+    With fuse_affine, runs of consecutive geometric ops are composed into one affine
+    matrix, so the image is resampled once per run instead of once per op.
+    With fuse_lut, runs of consecutive pointwise ops are composed into one lookup table.
+    """
+    matrix, run = None, []
+    for name, level in ops:
+        augment_fn, low, high = get_augment(name)
+        v = level * (high - low) + low
+        if fuse_affine and name in affine_dict:
+            img, run = _apply_pointwise(img, run, ctx), []
+            m = affine_dict[name](img.size, v)
+            matrix = m if matrix is None else compose_affine(matrix, m)
+            continue
+        img, matrix = _apply_affine(img, matrix), None
+        if fuse_lut and name in lut_dict:
+            run.append((name, level))
+            continue
+        img, run = _apply_pointwise(img, run, ctx), []
+        img = _apply_op(img, name, v, ctx)
+    return _apply_pointwise(_apply_affine(img, matrix), run, ctx)
+
+
+def _apply_op(img, name, v, ctx):
+    if ctx is not None and img is ctx.img and name in enhance_ops:
+        return ctx.enhance(name, v)
+    # ops never modify their input in place, no need to copy
+    return get_augment(name)[0](img, v)
+
+
+def _apply_affine(img, matrix):
+    if matrix is None:
+        return img
+    return img.transform(img.size, PIL.Image.AFFINE, matrix)
+
+
+def _apply_pointwise(img, run, ctx=None):
+    if len(run) == 1:
+        # a single PIL op is as cheap as a table lookup
+        name, level = run[0]
+        _, low, high = get_augment(name)
+        return _apply_op(img, name, level * (high - low) + low, ctx)
+    lut = None
+    for name, level in run:
+        table = get_lut(name, level)
+        if name == 'Contrast':
+            # needs the mean of the image as it is at this point of the run
+            if lut is not None:
+                img, lut = apply_lut(img, lut), None
+            table = table[ctx.mean() if ctx is not None and img is ctx.img else contrast_mean(img)]
+        lut = table if lut is None else table[lut]
+    if lut is not None:
+        img = apply_lut(img, lut)
+    return img
+
+
 class Lighting(object):
     """Lighting noise(AlexNet - style PCA - based noise)"""
 
@@ -226,7 +469,7 @@ class RandAugment:
         self.augment_list = augment_list()
 
     def __call__(self, img):
-        ops = random.choices(self.augment_list, k=self.n)
+        ops = rng.choices(self.augment_list, k=self.n)
         for op, minval, maxval in ops:
             val = (float(self.m) / 30) * float(maxval - minval) + minval
             img = op(img, val)
@@ -0,0 +1,217 @@
+# throughput benchmark of the augmentation hot path
+#   python -m AdapAug.benchmark --backend pil batch --size 32 224 --out bench.jsonl
+# writes one json record per line: a 'meta' record describing the host, then one record
+# per (backend, size, op, magnitude bin) and per (backend, size, archived policy), per
+# (size, device, batch size) for the grouped and per-sample BatchAugmentation, and per
+# (ImageNet crop, input size) for the two-step crop + Resize against the fused crop-resize.
+# latency is measured per call: one image on the PIL path, one batch on the batched backends
+# ('batch': the tensor ops, 'auto': per op on the faster side, see batch_augmentations.cpu_batched).
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import PIL
+import torch
+from PIL import Image
+
+from torchvision.transforms import transforms
+
+from AdapAug import augmentations, batch_augmentations, rng
+from AdapAug.archive import arsaug_policy, autoaug_paper_cifar10, fa_reduced_cifar10, fa_reduced_svhn
+from AdapAug.data import Augmentation, EfficientNetCenterCrop, EfficientNetRandomCrop
+
+policy_dict = {
+    'autoaug_paper_cifar10': autoaug_paper_cifar10,
+    'fa_reduced_cifar10': fa_reduced_cifar10,
+    'fa_reduced_svhn': fa_reduced_svhn,
+    'arsaug_policy': arsaug_policy,
+}
+
+
+def get_images(size, n, seed=0):
+    # uint8 [N, H, W, 3]; noise plus a gradient, so histogram ops see a spread of levels
+    rs = np.random.RandomState(seed)
+    grad = np.linspace(0, 160, size, dtype=np.float32).reshape(1, size, 1, 1)
+    imgs = grad + rs.randint(0, 96, (n, size, size, 3))
+    return imgs.astype(np.uint8)
+
+
+def _timeit(fn, calls, warmup=1):
+    for _ in range(warmup):
+        fn()
+    elapsed = []
+    for _ in range(calls):
+        t = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - t)
+    return np.array(elapsed)
+
+
+def _record(kind, backend, size, name, elapsed, images_per_call, **kwargs):
+    record = {
+        'kind': kind, 'backend': backend, 'size': size, 'name': name,
+        'images_per_call': images_per_call, 'calls': len(elapsed),
+        'images_per_sec': images_per_call * len(elapsed) / elapsed.sum(),
+        'p50_ms': float(np.percentile(elapsed, 50) * 1e3),
+        'p99_ms': float(np.percentile(elapsed, 99) * 1e3),
+    }
+    record.update(kwargs)
+    return record
+
+
+def _pil_calls(imgs, fn):
+    # one call per image, cycling through the batch
+    it = iter(())
+    def call():
+        nonlocal it
+        img = next(it, None)
+        if img is None:
+            it = iter(imgs)
+            img = next(it)
+        fn(img)
+    return call
+
+
+def bench_ops(backend, imgs, repeat, names=None):
+    size = imgs.shape[1]
+    pil_imgs = [Image.fromarray(img) for img in imgs]
+    batch = batch_augmentations.to_tensor(imgs)
+    ops = augmentations.augment_list() if backend == 'pil' else batch_augmentations.augment_list()
+    for fn, low, high in ops:
+        if names and fn.__name__ not in names:
+            continue
+        for m_id in range(10):
+            level = m_id / 10. + .1     # controller magnitude bins
+            v = level * (high - low) + low
+            if backend == 'pil':
+                elapsed = _timeit(_pil_calls(pil_imgs, lambda img: fn(img, v)), repeat * len(imgs))
+                n = 1
+            else:
+                vs = torch.full((len(batch),), v, dtype=torch.float64)
+                elapsed = _timeit(lambda: batch_augmentations.run_op(fn, batch, vs, backend), repeat)
+                n = len(batch)
+            yield _record('op', backend, size, fn.__name__, elapsed, n, m_id=m_id)
+
+
+def bench_policies(backend, imgs, repeat, names=None):
+    size = imgs.shape[1]
+    pil_imgs = [Image.fromarray(img) for img in imgs]
+    batch = batch_augmentations.to_tensor(imgs)
+    for name, policy_fn in policy_dict.items():
+        if names and name not in names:
+            continue
+        policy = policy_fn()
+        if backend == 'pil':
+            elapsed = _timeit(_pil_calls(pil_imgs, Augmentation(policy)), repeat * len(imgs))
+            n = 1
+        else:
+            elapsed = _timeit(lambda: batch_augmentations.apply_policy(batch, policy, backend), repeat)
+            n = len(batch)
+        yield _record('policy', backend, size, name, elapsed, n)
+
+
+def bench_executor(imgs, batch_sizes, devices, repeat, n_subpolicy=5, n_op=2):
+    """
+    BatchAugmentation on Controller-style policies (every op applied, as with operation_prob=0),
+    grouped ('batch') against per-sample ('pil'), per device and batch size: the crossover of 'auto'
+    """
+    size = imgs.shape[1]
+    rs = np.random.RandomState(0)
+    n_ops = len(batch_augmentations.op_list)
+    for device in devices:
+        for n in batch_sizes:
+            batch = batch_augmentations.to_tensor(imgs[np.arange(n) % len(imgs)]).to(device)
+            shape = (n, n_subpolicy, n_op)
+            policies = torch.from_numpy(np.stack([rs.randint(n_ops, size=shape), np.full(shape, 10), rs.randint(10, size=shape)], -1))
+            for backend in ('batch', 'pil'):
+                executor = batch_augmentations.BatchAugmentation(backend=backend)
+                def call():
+                    executor(batch, policies)
+                    if device == 'cuda':
+                        torch.cuda.synchronize()
+                elapsed = _timeit(call, repeat)
+                yield _record('executor', backend, size, 'controller', elapsed, n, device=device)
+
+
+def bench_crops(imgs, input_size, repeat):
+    # same crop boxes for both paths: every call draws under the key of its image.
+    # crop_diff, the mean abs difference of the paths in uint8 levels, is not a rounding-only 0:
+    # the fused resample reads pixels beyond the crop edges and it grows with the upscaling.
+    # on get_images of 300 / 375 / 500 px (batch 16 and 64) it stays below 0.065 (random crop)
+    # and 0.04 (center crop) for input 224, 0.11 and 0.045 for input 380 (300 px -> 380 the largest).
+    size = imgs.shape[1]
+    pil_imgs = [Image.fromarray(img) for img in imgs]
+    resize = transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC)
+    for name, crop in (('EfficientNetRandomCrop', EfficientNetRandomCrop), ('EfficientNetCenterCrop', EfficientNetCenterCrop)):
+        paths = {
+            'two_step': transforms.Compose([crop(input_size), resize]),
+            'fused': crop(input_size, resize=True),
+        }
+        outs = {}
+        for backend, transform in paths.items():
+            def call(img, transform=transform):
+                with rng.keyed(0, 0, id(img) % 2 ** 32):
+                    return transform(img)
+            outs[backend] = [np.asarray(call(img), dtype=np.float32) for img in pil_imgs]
+            elapsed = _timeit(_pil_calls(pil_imgs, call), repeat * len(imgs))
+            yield _record('crop', backend, size, name, elapsed, 1, input_size=input_size)
+        diff = np.mean([np.abs(a - b).mean() for a, b in zip(outs['two_step'], outs['fused'])])
+        yield {'kind': 'crop_diff', 'size': size, 'name': name, 'input_size': input_size, 'mean_abs_diff': float(diff)}
+
+
+def meta(args):
+    return {
+        'kind': 'meta', 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+        'python': platform.python_version(), 'torch': torch.__version__, 'PIL': PIL.__version__,
+        'numpy': np.__version__, 'torch_threads': torch.get_num_threads(), 'args': vars(args),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', type=str, nargs='+', default=['pil', 'batch'], choices=['pil', 'batch', 'auto'])
+    parser.add_argument('--size', type=int, nargs='+', default=[32, 224])
+    parser.add_argument('--batch', type=int, default=64, help='images per batched call / distinct PIL images')
+    parser.add_argument('--repeat', type=int, default=5, help='passes over the batch per measurement')
+    parser.add_argument('--ops', type=str, nargs='*', help='only these ops (default: all of augment_list())')
+    parser.add_argument('--policies', type=str, nargs='*', help='only these policies (default: %s)' % ', '.join(policy_dict))
+    parser.add_argument('--executor-batch', type=int, nargs='*', default=[16, 64, 256],
+                        help='batch sizes of the BatchAugmentation benchmark, none to skip')
+    parser.add_argument('--crop-source', type=int, default=500, help='source image size of the crop benchmark')
+    parser.add_argument('--crop-input', type=int, nargs='*', default=[224, 380], help='input sizes of the crop benchmark, none to skip')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument('--out', type=str, default='', help='jsonl output path (default: stdout)')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    out = open(args.out, 'w') if args.out else sys.stdout
+
+    def write(record):
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+    write(meta(args))
+    for size in args.size:
+        imgs = get_images(size, args.batch)
+        for backend in args.backend:
+            if args.ops is None or args.ops:
+                for record in bench_ops(backend, imgs, args.repeat, args.ops):
+                    write(record)
+            if args.policies is None or args.policies:
+                for record in bench_policies(backend, imgs, args.repeat, args.policies):
+                    write(record)
+        if args.executor_batch:
+            devices = ['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu']
+            for record in bench_executor(imgs, args.executor_batch, devices, args.repeat):
+                write(record)
+    if args.crop_input:
+        imgs = get_images(args.crop_source, args.batch)
+        for input_size in args.crop_input:
+            for record in bench_crops(imgs, input_size, args.repeat):
+                write(record)
+    if out is not sys.stdout:
+        out.close()
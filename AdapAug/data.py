@@ -2,23 +2,34 @@ import logging
 
 import numpy as np
 import os, copy
+import struct
+import zipfile
 
 import math
-import random
+import queue
+import threading
 import torch
 import torchvision
 from PIL import Image
 
-from torch.utils.data import Dataset, SubsetRandomSampler, Sampler, Subset, ConcatDataset
+from torch.utils.data import Dataset, IterableDataset, SubsetRandomSampler, Sampler, Subset, ConcatDataset
 import torch.distributed as dist
 from torchvision.transforms import transforms
 from sklearn.model_selection import StratifiedShuffleSplit, PredefinedSplit
 from theconf import Config as C
 
 from AdapAug.archive import arsaug_policy, autoaug_policy, autoaug_paper_cifar10, fa_reduced_cifar10, fa_reduced_svhn, fa_resnet50_rimagenet
+from AdapAug import rng
 from AdapAug.augmentations import *
+from AdapAug.batch_augmentations import BatchAugmentation
 from AdapAug.common import get_logger
+from AdapAug.eval_cache import CleanViews, ResidentLoader, resident_source
 from AdapAug.imagenet import ImageNet
+from AdapAug.imagenet_shards import ShardedImageNet, has_shards
+from AdapAug.loader_tuner import default_settings, host_signature, transform_signature, tune
+from AdapAug.npy_store import NpyDataset, has_store, load_store, store_parts, store_path, vision_dataset
+from AdapAug.policy_table import store_policies
+from AdapAug.view_cache import cache_key
 from AdapAug.networks.efficientnet_pytorch.model import EfficientNet
 from collections import Counter
 op_list = augment_list(False)
@@ -40,15 +51,28 @@ _SVHN_MEAN, _SVHN_STD = (0.4377, 0.4438, 0.4728), (0.1980, 0.2010, 0.1970)
 
 class AdapAugData(Dataset):
     def __init__(self, dataname, controller=None, transform=None, given_policy=None, target_transform=None, clean_transform=None, batch_multiplier=1, **kwargs):
-        dataset = torchvision.datasets.__dict__[dataname](transform=None, **kwargs)
         self.dataname = dataname
+        root = kwargs.get('root')
+        split = kwargs.get('split', 'train' if kwargs.get('train', True) else 'test')
         if dataname == "SVHN":
+            split = split + '_extra'
+        self.store = None   # (root, dataname, split) of the memory-mapped store the arrays come from
+        if has_store(root, dataname, split):
+            # memory-mapped NHWC uint8 store (npy_store.py), shared by all processes
+            logger.info('%s %s: memory-mapped from %s' % (dataname, split, store_path(root, dataname, split)))
+            self.store = (root, dataname, split)
+            self._load()
+            if dataname == "SVHN":
+                self.len_list = store_parts(root, dataname, split)
+        elif dataname == "SVHN":
+            dataset = torchvision.datasets.__dict__[dataname](transform=None, **kwargs)
             kwargs['split'] = 'extra'
             extraset = torchvision.datasets.__dict__[dataname](transform=None, **kwargs)
             self.len_list = [len(dataset), len(extraset)]
             self.data = np.transpose(np.concatenate([dataset.data, extraset.data]), (0,2,3,1))
             self.targets = self.labels = list(dataset.labels) + list(extraset.labels)
         else:
+            dataset = torchvision.datasets.__dict__[dataname](transform=None, **kwargs)
             self.data = dataset.data
             self.targets = self.labels = dataset.targets
         self.transform = transform
@@ -68,12 +92,69 @@ class AdapAugData(Dataset):
         self.given_policy = given_policy
         self.log_probs = None
         self.policies = None
+        self.policy_table = None    # shared memory behind policies / log_probs (policy_table.py)
 
         self.batch_multiplier = batch_multiplier
+        self.view_cache = None
+        self.stream = False     # raw images for PolicyStream instead of pre-sampled policies
+        self.collate = False    # multi-view samples unaugmented, ViewCollate makes the views
+        self.clean_views = None     # CleanViews: the clean image slot holds the sample index
+
+    def _load(self):
+        self.data, self.targets = load_store(*self.store)
+        self.labels = self.targets
+
+    def __getstate__(self):
+        # re-map the store in the receiving process (spawn / forkserver workers) instead of pickling the images
+        state = self.__dict__.copy()
+        if self.store is not None:
+            for k in ('data', 'targets', 'labels'):
+                del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.store is not None:
+            self._load()
 
     def __len__(self):
         return len(self.data)
 
+    def view_shape(self):
+        """[C, H, W] of an augmented view when the transform is a fused CropFlipNormalize, else None"""
+        fused = getattr(self.transform, 'transforms', [])
+        if len(fused) == 1 and isinstance(fused[0], CropFlipNormalize):
+            return fused[0].output_shape()
+        return None
+
+    def augment_views(self, img, policies, index=None, out=None):
+        """
+        One augmented view of img per policy, stacked: [M, C, H, W], written into out when given.
+        The views share one EnhanceContext and, with a fused CropFlipNormalize transform,
+        are written straight into the output tensor. View m draws from rng stream m.
+        """
+        ctx = EnhanceContext(img)
+        fused = self.transform.transforms[0] if self.view_shape() is not None else None
+        if out is None and fused is not None:
+            out = torch.empty((len(policies),) + fused.output_shape(), dtype=torch.float32)
+        views = []
+        for m, policy in enumerate(policies):
+            with rng.view(m):
+                aug_img = Augmentation(policy)(img, ctx, self.view_cache, index)
+                if fused is not None:
+                    fused(aug_img, out=out[m])
+                elif out is not None:
+                    out[m] = self.transform(aug_img)
+                else:
+                    views.append(self.transform(aug_img))
+        return out if out is not None else torch.stack(views)
+
+    def _policy(self, index):
+        """(log_prob, policy) of sample index, from the PolicyTable when there is one (not torn by an update)"""
+        if self.policy_table is not None:
+            return self.policy_table.read(index)
+        return np.asarray(self.log_probs[index], dtype=np.float32), np.asarray(self.policies[index], dtype=np.int64)
+
     def __getitem__(self, index):
         """
         Args:
@@ -83,47 +164,45 @@ class AdapAugData(Dataset):
             tuple: (image, target) where target is index of the target class.
         """
         img, target = self.data[index], self.targets[index]
+        if self.stream:
+            # uint8 [C, H, W] for the batch-level policy stage, and the controller input
+            raw = torch.from_numpy(np.array(img)).permute(2, 0, 1)
+            img = index if self.clean_views is not None else self.clean_transform(Image.fromarray(img))
+            if self.target_transform is not None:
+                target = self.target_transform(target)
+            return (raw, img), target
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
         img = Image.fromarray(img)
+        if self.collate and (self.policies is not None or self.controller is None):
+            # the views are augmented by ViewCollate, straight into the batch
+            if self.target_transform is not None:
+                target = self.target_transform(target)
+            if self.policies is None:
+                return (index, img, None, None, None), target
+            log_prob, policy = self._policy(index)
+            return (index, img, index if self.clean_views is not None else self.clean_transform(img), log_prob, policy), target
         if self.transform is not None:
             if self.policies is not None: # CTL Training
-                log_prob = self.log_probs[index] # [M]
-                policy = self.policies[index] # [M]
+                log_prob, policy = self._policy(index) # [M], [M, n_subpolicy, n_op, 3]
                 if self.batch_multiplier > 1:
-                    aug_imgs = []
-                    for pol in policy:
-                        # aug_img = self.before_transform(img)
-                        # aug_img = Augmentation(pol)(aug_img)
-                        # aug_img = self.after_transform(aug_img)
-                        aug_img = Augmentation(pol)(img)
-                        aug_img = self.transform(aug_img)
-                        aug_imgs.append(aug_img)
-                    aug_img =  torch.stack(aug_imgs) # [M, 3, 32, 32]
+                    aug_img = self.augment_views(img, policy, index) # [M, 3, 32, 32]
                 else:
                     # aug_img = self.before_transform(img)
                     # aug_img = Augmentation(policy)(aug_img)
                     # aug_img = self.after_transform(aug_img)
-                    aug_img = Augmentation(policy)(img)
+                    aug_img = Augmentation(policy)(img, cache=self.view_cache, index=index)
                     aug_img = self.transform(aug_img)
-                img = self.clean_transform(img)
+                img = index if self.clean_views is not None else self.clean_transform(img)
             else:
                 if self.controller is None: # Adversarial AutoAugment
                     if self.batch_multiplier > 1:
-                        imgs = []
-                        for policy in self.given_policy:
-                            # aug_img = self.before_transform(img)
-                            # aug_img = Augmentation(policy)(aug_img)
-                            # aug_img = self.after_transform(aug_img)
-                            aug_img = Augmentation(policy)(img)
-                            aug_img = self.transform(aug_img)
-                            imgs.append(aug_img)
-                        img = torch.stack(imgs) # [M, 3, 32, 32]
+                        img = self.augment_views(img, self.given_policy, index) # [M, 3, 32, 32]
                     else:
                         img = self.transform(img)
                 else: # AdapAug temp_loader
-                    img = self.clean_transform(img)
+                    img = self.clean_views[index] if self.clean_views is not None else self.clean_transform(img)
 
         if self.target_transform is not None:
             target = self.target_transform(target)
@@ -132,7 +211,59 @@ class AdapAugData(Dataset):
             return (aug_img, img, log_prob, policy), target
         else:
             return img, target
-def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode=-1, gr_assign=None, gr_ids=None, controller=None, _transform=None, rand_val=False, batch_multiplier=1, validation=False):
+
+
+class HeldOutView(Dataset):
+    """
+    Samples of an AdapAugData or NpyDataset (uint8 NHWC data) under another transform, without
+    policies, controller or extra views: the held-out test split of validation=True. Shares the
+    image and label arrays of the dataset read-only instead of copying them.
+    """
+    def __init__(self, dataset, transform):
+        # (root, dataname, split) of a memory-mapped store, re-mapped on unpickle
+        self.store = getattr(dataset, 'store', None) if isinstance(dataset, AdapAugData) \
+            else (dataset.root, dataset.dataname, dataset.split)
+        self.data = dataset.data
+        self.targets = self.labels = dataset.targets
+        self.transform = transform
+        self.target_transform = dataset.target_transform
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.store is not None:
+            for k in ('data', 'targets', 'labels'):
+                del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.store is not None:
+            self.data, self.targets = load_store(*self.store)
+            self.labels = self.targets
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        img, target = Image.fromarray(self.data[index]), self.targets[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+def _rank_and_world_size(multinode):
+    """(rank, world_size) of a multinode run (multinode: True or a local rank >= 0), else (0, 1)"""
+    if multinode is False or (not isinstance(multinode, bool) and multinode < 0):
+        return 0, 1
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    # train.py builds the loaders before init_process_group: the launcher's environment
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode=-1, gr_assign=None, gr_ids=None, controller=None, _transform=None, rand_val=False, batch_multiplier=1, validation=False, rng_seed=None, rng_epoch=0, view_cache=None, split_cache=None, draft_margin=0., stream_policies=False, loader_tune=False, resident_eval=None, clean_cache=None):
     if _transform is None:
         _transform = C.get()['aug']
     if 'cifar' in dataset or 'svhn' in dataset:
@@ -140,11 +271,9 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
             _mean, _std = _CIFAR_MEAN, _CIFAR_STD
         else:
             _mean, _std = _SVHN_MEAN, _SVHN_STD
+        # RandomCrop(32, padding=4), RandomHorizontalFlip, ToTensor, Normalize (and CutoutDefault) in one pass
         transform_train = transforms.Compose([
-            transforms.RandomCrop(32, padding=4),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(_mean, _std),
+            CropFlipNormalize(32, 4, _mean, _std),
         ])
         transform_test = transforms.Compose([
             transforms.ToTensor(),
@@ -162,8 +291,7 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
             logger.info('size changed to %d/%d.' % (input_size, sized_size))
 
         transform_train = transforms.Compose([
-            EfficientNetRandomCrop(input_size),
-            transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC),
+            EfficientNetRandomCrop(input_size, resize=True),
             # transforms.RandomResizedCrop(input_size, scale=(0.1, 1.0), interpolation=Image.BICUBIC),
             transforms.RandomHorizontalFlip(),
             transforms.ColorJitter(
@@ -177,8 +305,7 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         ])
 
         transform_test = transforms.Compose([
-            EfficientNetCenterCrop(input_size),
-            transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC),
+            EfficientNetCenterCrop(input_size, resize=True),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
@@ -218,7 +345,10 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
             raise ValueError('not found augmentations. %s' % _transform)
 
     if C.get()['cutout'] > 0 and _transform != "nocut":
-        transform_train.transforms.append(CutoutDefault(C.get()['cutout']))
+        if isinstance(transform_train.transforms[-1], CropFlipNormalize):
+            transform_train.transforms[-1].cutout = C.get()['cutout']
+        else:
+            transform_train.transforms.append(CutoutDefault(C.get()['cutout']))
     if _transform == "clean":
         transform_train = transform_test
     elif _transform == "nonorm":
@@ -230,140 +360,140 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         if controller is not None or batch_multiplier > 1:
             total_trainset = AdapAugData("CIFAR10", root=dataroot, controller=controller, train=True, download=False, transform=transform_train, clean_transform=transform_test, given_policy=_transform, batch_multiplier=batch_multiplier)
         else:
-            total_trainset = torchvision.datasets.CIFAR10(root=dataroot, train=True, download=False, transform=transform_train)
-        testset = torchvision.datasets.CIFAR10(root=dataroot, train=False, download=False, transform=transform_test)
+            total_trainset = vision_dataset('CIFAR10', dataroot, 'train', transform_train)
+        testset = vision_dataset('CIFAR10', dataroot, 'test', transform_test)
     elif dataset == 'reduced_cifar10':
         if controller is not None or batch_multiplier > 1:
             total_trainset = AdapAugData("CIFAR10", root=dataroot, controller=controller, train=True, download=False, transform=transform_train, clean_transform=transform_test, given_policy=_transform, batch_multiplier=batch_multiplier)
         else:
-            total_trainset = torchvision.datasets.CIFAR10(root=dataroot, train=True, download=False, transform=transform_train)
-        sss = StratifiedShuffleSplit(n_splits=5, train_size=4000, random_state=0)   # 4000 trainset
-        sss = sss.split(list(range(len(total_trainset))), total_trainset.targets)
-        for _ in range(split_idx+1):
-            train_idx, valid_idx = next(sss)
-        testset = torchvision.datasets.CIFAR10(root=dataroot, train=False, download=False, transform=transform_test)
+            total_trainset = vision_dataset('CIFAR10', dataroot, 'train', transform_train)
+        testset = vision_dataset('CIFAR10', dataroot, 'test', transform_test)
     elif dataset == 'cifar100':
         if controller is not None or batch_multiplier > 1:
             total_trainset = AdapAugData("CIFAR100", root=dataroot, controller=controller, train=True, download=False, transform=transform_train, clean_transform=transform_test, given_policy=_transform, batch_multiplier=batch_multiplier)
         else:
-            total_trainset = torchvision.datasets.CIFAR100(root=dataroot, train=True, download=False, transform=transform_train)
-        testset = torchvision.datasets.CIFAR100(root=dataroot, train=False, download=False, transform=transform_test)
+            total_trainset = vision_dataset('CIFAR100', dataroot, 'train', transform_train)
+        testset = vision_dataset('CIFAR100', dataroot, 'test', transform_test)
     elif dataset == 'svhn': #TODO
         if controller is not None or batch_multiplier > 1:
             total_trainset = AdapAugData("SVHN", root=dataroot, controller=controller, split='train', download=False, transform=transform_train, clean_transform=transform_test, given_policy=_transform, batch_multiplier=batch_multiplier)
-            if split > 0.0:
-                sss = StratifiedShuffleSplit(n_splits=5, test_size=split, random_state=0)
-                sss1 = sss.split(list(range(total_trainset.len_list[0])), total_trainset.targets[:total_trainset.len_list[0]])
-                sss2 = sss.split(list(range(total_trainset.len_list[1])), total_trainset.targets[total_trainset.len_list[0]:])
-                for _ in range(split_idx + 1):
-                    train_idx1, valid_idx1 = next(sss1)
-                    train_idx2, valid_idx2 = next(sss2)
-                train_idx, valid_idx = list(train_idx1)+list(train_idx2), list(valid_idx1)+list(valid_idx2)
         else:
-            total_trainset = torchvision.datasets.SVHN(root=dataroot, split='train', download=False, transform=transform_train)
+            total_trainset = vision_dataset('SVHN', dataroot, 'train', transform_train)
             # extraset = torchvision.datasets.SVHN(root=dataroot, split='extra', download=False, transform=transform_train)
             # total_trainset = ConcatDataset([trainset, extraset])
             total_trainset.targets = total_trainset.labels
-        testset = torchvision.datasets.SVHN(root=dataroot, split='test', download=False, transform=transform_test)
+        testset = vision_dataset('SVHN', dataroot, 'test', transform_test)
     elif dataset == 'reduced_svhn':
         if controller is not None or batch_multiplier > 1:
             total_trainset = AdapAugData("SVHN", root=dataroot, controller=controller, split='train', download=False, transform=transform_train, clean_transform=transform_test, given_policy=_transform, batch_multiplier=batch_multiplier)
         else:
-            total_trainset = torchvision.datasets.SVHN(root=dataroot, split='train', download=False, transform=transform_train)
-        sss = StratifiedShuffleSplit(n_splits=5, train_size=1000, test_size=7325, random_state=0)
-        sss = sss.split(list(range(len(total_trainset))), total_trainset.labels)
-        for _ in range(split_idx+1):
-            train_idx, valid_idx = next(sss)
+            total_trainset = vision_dataset('SVHN', dataroot, 'train', transform_train)
         # targets = [total_trainset.labels[idx] for idx in train_idx]
         # total_trainset = Subset(total_trainset, train_idx)
         # total_trainset.targets = targets
-        testset = torchvision.datasets.SVHN(root=dataroot, split='test', download=False, transform=transform_test)
+        testset = vision_dataset('SVHN', dataroot, 'test', transform_test)
     elif dataset == 'imagenet':
-        total_trainset = ImageNet(root=os.path.join(dataroot, 'imagenet-pytorch'), transform=transform_train)
-        testset = ImageNet(root=os.path.join(dataroot, 'imagenet-pytorch'), split='val', transform=transform_test)
-
-        # compatibility
-        total_trainset.targets = [lb for _, lb in total_trainset.samples]
+        imagenet_root = os.path.join(dataroot, 'imagenet-pytorch')
+        if split == 0.0 and has_shards(imagenet_root, 'train'):
+            # sequential reads of the packed shards (python -m AdapAug.imagenet_shards)
+            rank, world_size = _rank_and_world_size(multinode)
+            total_trainset = ShardedImageNet(imagenet_root, 'train', transform=transform_train, rank=rank, world_size=world_size)
+        else:
+            total_trainset = ImageNet(root=imagenet_root, transform=transform_train)
+        if has_shards(imagenet_root, 'val'):
+            testset = ShardedImageNet(imagenet_root, 'val', transform=transform_test, shuffle=False)
+        else:
+            testset = ImageNet(root=imagenet_root, split='val', transform=transform_test)
     elif dataset == 'reduced_imagenet':
         # randomly chosen indices
         # idx120 = sorted(random.sample(list(range(1000)), k=120))
         idx120 = [16, 23, 52, 57, 76, 93, 95, 96, 99, 121, 122, 128, 148, 172, 181, 189, 202, 210, 232, 238, 257, 258, 259, 277, 283, 289, 295, 304, 307, 318, 322, 331, 337, 338, 345, 350, 361, 375, 376, 381, 388, 399, 401, 408, 424, 431, 432, 440, 447, 462, 464, 472, 483, 497, 506, 512, 530, 541, 553, 554, 557, 564, 570, 584, 612, 614, 619, 626, 631, 632, 650, 657, 658, 660, 674, 675, 680, 682, 691, 695, 699, 711, 734, 736, 741, 754, 757, 764, 769, 770, 780, 781, 787, 797, 799, 811, 822, 829, 830, 835, 837, 842, 843, 845, 873, 883, 897, 900, 902, 905, 913, 920, 925, 937, 938, 940, 941, 944, 949, 959]
-        total_trainset = ImageNet(root=os.path.join(dataroot, 'imagenet-pytorch'), transform=transform_train)
-        testset = ImageNet(root=os.path.join(dataroot, 'imagenet-pytorch'), split='val', transform=transform_test)
+        imagenet_root = os.path.join(dataroot, 'imagenet-pytorch')
+        total_trainset = ImageNet(root=imagenet_root, transform=transform_train)
 
-        # compatibility
-        total_trainset.targets = [lb for _, lb in total_trainset.samples]
+        # 1000 -> 120 label lookup, -1 for the dropped classes
+        remap = np.full(1000, -1, dtype=np.int64)
+        remap[idx120] = np.arange(len(idx120))
+        train_labels = remap[np.asarray(total_trainset.targets, dtype=np.int16)]
 
         sss = StratifiedShuffleSplit(n_splits=1, test_size=len(total_trainset) - 50000, random_state=0)  # 4000 trainset
-        sss = sss.split(list(range(len(total_trainset))), total_trainset.targets)
+        sss = sss.split(np.zeros(len(total_trainset)), total_trainset.targets)
         train_idx, valid_idx = next(sss)
 
         # filter out
-        train_idx = list(filter(lambda x: total_trainset.labels[x] in idx120, train_idx))
-        valid_idx = list(filter(lambda x: total_trainset.labels[x] in idx120, valid_idx))
-        test_idx = list(filter(lambda x: testset.samples[x][1] in idx120, range(len(testset))))
+        train_idx = train_idx[train_labels[train_idx] >= 0]
+        valid_idx = valid_idx[train_labels[valid_idx] >= 0]
 
-        targets = [idx120.index(total_trainset.targets[idx]) for idx in train_idx]
-        for idx in range(len(total_trainset.samples)):
-            if total_trainset.samples[idx][1] not in idx120:
-                continue
-            total_trainset.samples[idx] = (total_trainset.samples[idx][0], idx120.index(total_trainset.samples[idx][1]))
+        targets = train_labels[train_idx].tolist()
+        train_mask = train_labels >= 0
+        total_trainset.relabel(train_mask, train_labels[train_mask])
         total_trainset = Subset(total_trainset, train_idx)
         total_trainset.targets = targets
 
-        for idx in range(len(testset.samples)):
-            if testset.samples[idx][1] not in idx120:
-                continue
-            testset.samples[idx] = (testset.samples[idx][0], idx120.index(testset.samples[idx][1]))
-        testset = Subset(testset, test_idx)
+        if has_shards(imagenet_root, 'val'):
+            # records of the other classes are skipped unread
+            testset = ShardedImageNet(imagenet_root, 'val', transform=transform_test, label_map=remap, shuffle=False)
+        else:
+            testset = ImageNet(root=imagenet_root, split='val', transform=transform_test)
+            test_labels = remap[np.asarray(testset.targets, dtype=np.int16)]
+            test_mask = test_labels >= 0
+            testset.relabel(test_mask, test_labels[test_mask])
+            testset = Subset(testset, np.flatnonzero(test_mask))
         print('reduced_imagenet train=', len(total_trainset))
     else:
         raise ValueError('invalid dataset name=%s' % dataset)
 
-    if isinstance(total_trainset, AdapAugData) and total_trainset.policies is None and total_trainset.controller is not None:
-        with torch.no_grad():
-            temp_loader = torch.utils.data.DataLoader(
-                        total_trainset, batch_size=batch*batch_multiplier, shuffle=False, num_workers=4,
-                        drop_last=False)
-            policies = []
-            log_probs = []
-            total_trainset.controller.eval()
-            for data, _ in temp_loader:
-                mpolicy = []
-                mlog_prob = []
-                for m in range(batch_multiplier):
-                    log_prob, _, sampled_policies = total_trainset.controller(data.cuda())
-                    mpolicy.append(sampled_policies.detach().cpu())
-                    mlog_prob.append(log_prob.detach().cpu())
-                policies.append(torch.stack(mpolicy)) # [M, datalen, ...]
-                log_probs.append(torch.stack(mlog_prob)) # [M, datalen]
-            total_trainset.policies  = torch.cat(policies, dim=1)
-            total_trainset.log_probs = torch.cat(log_probs, dim=1)
-            if batch_multiplier > 1:
-                total_trainset.policies  = total_trainset.policies.permute(1,0,2,3,4).cpu().numpy()
-                total_trainset.log_probs = total_trainset.log_probs.T.cpu().numpy()
-            else:
-                total_trainset.policies  = total_trainset.policies[0].cpu().numpy()
-                total_trainset.log_probs = total_trainset.log_probs[0].cpu().numpy()
+    if draft_margin:
+        # reduced-scale JPEG decoding, the crops stay at least draft_margin times the network input
+        for d in (total_trainset, testset):
+            d = d.dataset if isinstance(d, Subset) else d
+            if isinstance(d, (ImageNet, ShardedImageNet)):
+                d.set_draft(draft_margin)
+    adaptive = isinstance(total_trainset, AdapAugData) and total_trainset.policies is None and total_trainset.controller is not None
+    if clean_cache and adaptive and CleanViews.supports(total_trainset):
+        # clean views computed once, batches and traces carry sample indices into them
+        total_trainset.clean_views = CleanViews(total_trainset, torch.float16 if clean_cache == 'float16' else torch.float32)
+        logger.info('%s clean views: %d MB' % (dataset, total_trainset.clean_views.nbytes() >> 20))
+    train_settings = dict(default_settings)
+    valid_settings = dict(default_settings, num_workers=4)
+    if loader_tune:
+        # short probe of the train pipeline, stream_policies='auto' also compares the policy stages
+        modes = [False, True] if adaptive and stream_policies == 'auto' else [adaptive and bool(stream_policies)]
+        # workers holding per-epoch state (KeyedRNG, ShardedImageNet) must be restarted every epoch
+        persistent = rng_seed is None and not isinstance(total_trainset, IterableDataset)
+        stream_policies, train_settings = tune_loader(total_trainset, dataset, transform_train, batch, batch_multiplier, modes,
+                                                      persistent, cache_dir=os.path.join(dataroot, 'loader_tune'))
+        valid_settings = train_settings
+    stream = False
+    if adaptive:
+        if stream_policies and stream_policies != 'auto':
+            # no pre-pass: PolicyStream samples the policies of every batch
+            stream = total_trainset.stream = True
+        else:
+            sample_policies(total_trainset, total_trainset.controller, batch, batch_multiplier)
+    collate = False
+    base = total_trainset.dataset if isinstance(total_trainset, Subset) else total_trainset
+    if isinstance(base, AdapAugData) and batch_multiplier > 1 and not stream:
+        # the M views are augmented into a view-major [M*batch, ...] batch at collate time
+        base.collate = collate = True
+    if view_cache is not None and isinstance(total_trainset, AdapAugData):
+        # deterministic post-policy views keyed by (index, resolved subpolicy)
+        set_view_cache(total_trainset, view_cache)
+    train_idx, valid_idx, test_idx = split_indices(dataset, total_trainset, split, split_idx, validation, train_idx, valid_idx,
+                                                   cache_dir=split_cache)
     if split > 0.0:
-        if train_idx is None or valid_idx is None:
-            # filter by split ratio
-            sss = StratifiedShuffleSplit(n_splits=5, test_size=split, random_state=0)
-            sss = sss.split(list(range(len(total_trainset))), total_trainset.targets)
-            for _ in range(split_idx + 1):
-                train_idx, valid_idx = next(sss)
         if validation:
-            sss = StratifiedShuffleSplit(n_splits=5, test_size=0.25, random_state=0)
-            sss = sss.split(list(range(len(valid_idx))), [total_trainset.targets[idx] for idx in valid_idx])
-            for _ in range(split_idx + 1):
-                _val_idx, _test_idx = next(sss)
-            test_idx  = [valid_idx[idx] for idx in _test_idx]
-            valid_idx = [valid_idx[idx] for idx in _val_idx] # D_A
             # build testset
             total_trainset.controller = None
-            testset = copy.deepcopy(total_trainset)
-            testset.transform = transform_test
-            testset.policies = None
+            if isinstance(total_trainset, (AdapAugData, NpyDataset)):
+                testset = HeldOutView(total_trainset, transform_test)
+            else:
+                # torchvision SVHN (NCHW data), ImageNet, Subset of reduced_imagenet
+                testset = copy.deepcopy(total_trainset)
+                testset.transform = transform_test
+                testset.policies = None
+                testset.stream = testset.collate = False
+                testset.clean_views = None
             testset = Subset(testset, test_idx)
         if controller is not None: # Adv AA
             train_idx = list(train_idx) + list(valid_idx) # D_T + D_V
@@ -377,18 +507,459 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         if train_idx is not None and valid_idx is not None:
             total_trainset = Subset(total_trainset, train_idx)
 
+    streaming = isinstance(total_trainset, IterableDataset)
+    if rng_seed is not None and not streaming:
+        # train augmentation draws keyed by (rng_seed, epoch, sample index, view)
+        train_dataset = KeyedRNG(total_trainset, rng_seed, rng_epoch)
+    else:
+        train_dataset = total_trainset
     trainloader = torch.utils.data.DataLoader(
-        total_trainset, batch_size=batch, shuffle=True if train_sampler is None else False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
-        sampler=train_sampler, drop_last=True)
+        train_dataset, batch_size=batch, shuffle=train_sampler is None and not streaming,
+        sampler=train_sampler, drop_last=True, collate_fn=ViewCollate(train_dataset) if collate else None, **train_settings)
     validloader = torch.utils.data.DataLoader(
-        total_trainset, batch_size=batch, shuffle=False, num_workers=4, pin_memory=True,
-        sampler=valid_sampler, drop_last=rand_val)
-    testloader = torch.utils.data.DataLoader(
-        testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
-        drop_last=False)
+        total_trainset if not streaming else [], batch_size=batch, shuffle=False,
+        sampler=valid_sampler, drop_last=rand_val, collate_fn=ViewCollate(total_trainset) if collate else None, **valid_settings)
+    if resident_eval and resident_source(testset) is not None:
+        # normalized once, 'float16' halves the memory
+        testloader = ResidentLoader(testset, batch, torch.float16 if resident_eval == 'float16' else torch.float32)
+        logger.info('%s test set resident: %d MB' % (dataset, testloader.nbytes() >> 20))
+    else:
+        testloader = torch.utils.data.DataLoader(
+            testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
+            drop_last=False)
+    if stream:
+        trainloader = PolicyStream(trainloader, controller, batch_multiplier)
+        validloader = PolicyStream(validloader, controller, batch_multiplier)
     return train_sampler, trainloader, validloader, testloader
 
 
+def _split_cache_path(cache_dir, dataset, total_trainset, split, split_idx, validation):
+    # every StratifiedShuffleSplit of split_indices uses random_state=0
+    return os.path.join(cache_dir, '%s_n%d_split%g_idx%d_rs0_val%d_i64.npz' % (dataset, len(total_trainset), split, split_idx, int(validation)))
+
+
+def _load_split(path):
+    # np.load ignores mmap_mode for .npz; np.savez stores the members uncompressed,
+    # so each array is memory-mapped at its offset inside the archive
+    indices = {}
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as raw:
+        for info in z.infolist():
+            with z.open(info) as f:
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, _, dtype = read_header(f)
+                header = f.tell()
+            raw.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', raw.read(4))
+            offset = info.header_offset + 30 + name_len + extra_len + header
+            indices[info.filename[:-len('.npy')]] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return tuple(indices.get(k) for k in ('train_idx', 'valid_idx', 'test_idx'))
+
+
+def _save_split(path, **indices):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+        # int64, the dtype the indices are used with, so they are read back without a copy
+        np.savez(tmp, **{k: np.asarray(v, dtype=np.int64) for k, v in indices.items() if v is not None})
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug('split indices not cached: %s' % e)
+
+
+def split_indices(dataset, total_trainset, split=0.15, split_idx=0, validation=False, train_idx=None, valid_idx=None, cache_dir=None):
+    """
+    Split indices of get_dataloaders: (train_idx, valid_idx, test_idx).
+    train_idx, valid_idx: already chosen by the caller (reduced_imagenet), optional
+    test_idx: carved out of valid_idx with validation=True, None otherwise
+    cache_dir: computed indices of split > 0 are stored there as int64 .npz and read back
+        (memory-mapped) by later calls
+    """
+    test_idx = None
+    cache = None
+    if cache_dir is not None and train_idx is None and split > 0.0:
+        cache = _split_cache_path(cache_dir, dataset, total_trainset, split, split_idx, validation)
+        if os.path.isfile(cache):
+            return _load_split(cache)
+    if train_idx is None:
+        if dataset == 'reduced_cifar10':
+            sss = StratifiedShuffleSplit(n_splits=5, train_size=4000, random_state=0)   # 4000 trainset
+            sss = sss.split(list(range(len(total_trainset))), total_trainset.targets)
+            for _ in range(split_idx+1):
+                train_idx, valid_idx = next(sss)
+        elif dataset == 'svhn' and isinstance(total_trainset, AdapAugData) and split > 0.0:
+            sss = StratifiedShuffleSplit(n_splits=5, test_size=split, random_state=0)
+            sss1 = sss.split(list(range(total_trainset.len_list[0])), total_trainset.targets[:total_trainset.len_list[0]])
+            sss2 = sss.split(list(range(total_trainset.len_list[1])), total_trainset.targets[total_trainset.len_list[0]:])
+            for _ in range(split_idx + 1):
+                train_idx1, valid_idx1 = next(sss1)
+                train_idx2, valid_idx2 = next(sss2)
+            train_idx, valid_idx = list(train_idx1)+list(train_idx2), list(valid_idx1)+list(valid_idx2)
+        elif dataset == 'reduced_svhn':
+            sss = StratifiedShuffleSplit(n_splits=5, train_size=1000, test_size=7325, random_state=0)
+            sss = sss.split(list(range(len(total_trainset))), total_trainset.labels)
+            for _ in range(split_idx+1):
+                train_idx, valid_idx = next(sss)
+    if split > 0.0:
+        if train_idx is None or valid_idx is None:
+            # filter by split ratio
+            sss = StratifiedShuffleSplit(n_splits=5, test_size=split, random_state=0)
+            sss = sss.split(list(range(len(total_trainset))), total_trainset.targets)
+            for _ in range(split_idx + 1):
+                train_idx, valid_idx = next(sss)
+        if validation:
+            sss = StratifiedShuffleSplit(n_splits=5, test_size=0.25, random_state=0)
+            sss = sss.split(list(range(len(valid_idx))), [total_trainset.targets[idx] for idx in valid_idx])
+            for _ in range(split_idx + 1):
+                _val_idx, _test_idx = next(sss)
+            test_idx  = [valid_idx[idx] for idx in _test_idx]
+            valid_idx = [valid_idx[idx] for idx in _val_idx] # D_A
+    if cache is not None:
+        _save_split(cache, train_idx=train_idx, valid_idx=valid_idx, test_idx=test_idx)
+    return train_idx, valid_idx, test_idx
+
+
+class PolicyStream(object):
+    """
+    Loader of an AdapAugData in stream mode that samples the policies just in time: every
+    clean batch goes through the controller once per view, and the sampled policies are
+    applied to the raw batch in a batch-level stage (BatchAugmentation, then the train transform).
+    Yields the batches of the pre-sampled mode: ([aug_img, img, log_prob, policy], target),
+    view-major [M*batch, ...] as ViewCollate makes them when batch_multiplier > 1.
+    prefetch: batches a background thread fetches, samples and augments ahead of the consumer,
+        so the batch-level stage overlaps the training step; 0 runs it in the iterating thread.
+    Other attributes are those of the wrapped loader.
+    """
+    def __init__(self, loader, controller, batch_multiplier=1, prefetch=2):
+        self.loader = loader
+        self.controller = controller
+        self.batch_multiplier = batch_multiplier
+        self.prefetch = prefetch
+        self.augmentation = BatchAugmentation()
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _transform(self, dataset, imgs):
+        fused = getattr(dataset.transform, 'transforms', [])
+        if len(fused) == 1 and isinstance(fused[0], CropFlipNormalize):
+            return fused[0].batch(imgs)
+        return torch.stack([dataset.transform(Image.fromarray(img.permute(1, 2, 0).numpy())) for img in imgs])
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            yield from self._batches()
+            return
+        batches = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+
+        def put(item):
+            # False once the consumer is gone
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            if device is not None:
+                torch.cuda.set_device(device)
+            it = self._batches()
+            try:
+                for batch in it:
+                    if not put((batch, None)):
+                        return
+                put((None, None))
+            except BaseException as e:
+                put((None, e))
+            finally:
+                it.close()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            # also on an early break of the consumer: the thread stops at its next batch
+            stop.set()
+            thread.join()
+
+    def _batches(self):
+        dataset = self.loader.dataset
+        while isinstance(dataset, (Subset, KeyedRNG)):
+            dataset = dataset.dataset
+        for (raw, img), target in self.loader:
+            training = self.controller.training
+            self.controller.eval()
+            views, log_probs, policies = [], [], []
+            clean = img if dataset.clean_views is None else dataset.clean_views[img]
+            with torch.no_grad():
+                for m in range(self.batch_multiplier):
+                    log_prob, _, policy = self.controller(clean.cuda())
+                    policy = policy.detach().cpu()
+                    views.append(self._transform(dataset, self.augmentation(raw, policy)))
+                    log_probs.append(log_prob.detach().cpu())
+                    policies.append(policy)
+            self.controller.train(training)
+            if self.batch_multiplier > 1:
+                yield [torch.cat(views), img, torch.cat(log_probs), torch.cat(policies)], target.repeat(self.batch_multiplier)
+            else:
+                yield [views[0], img, log_probs[0], policies[0]], target
+
+
+def _batch_buffer(shape, dtype=torch.float32):
+    # in a loader worker, allocated in shared memory as default_collate does: not copied again on the way out
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+    elem = torch.empty(0, dtype=dtype)
+    return elem.new(elem._typed_storage()._new_shared(int(np.prod(shape)))).resize_(shape)
+
+
+class ViewCollate(object):
+    """
+    collate_fn of an AdapAugData with batch_multiplier > 1 in collate mode: the M views of every
+    sample are augmented straight into one [M*batch, C, H, W] buffer, view-major (the first views
+    of all samples, then the second ones, ...), the layout run_epoch trains on. Targets, log probs
+    and policies follow the same order; the clean images (indices with clean_views) stay [batch, ...].
+    Batches: ([aug_img, img, log_prob, policy], target) with pre-sampled policies,
+    (aug_img, target) with given_policy.
+    dataset: the dataset of the loader; under KeyedRNG the draws are keyed by (seed, epoch, sample index)
+    """
+    def __init__(self, dataset):
+        self.keyed = dataset if isinstance(dataset, KeyedRNG) else None
+        while isinstance(dataset, (Subset, KeyedRNG)):
+            dataset = dataset.dataset
+        self.dataset = dataset
+
+    def _views(self, index, img, policies, out=None):
+        if self.keyed is None:
+            return self.dataset.augment_views(img, policies, index, out=out)
+        with rng.keyed(self.keyed.seed, self.keyed.epoch, index):
+            return self.dataset.augment_views(img, policies, index, out=out)
+
+    def __call__(self, batch):
+        samples, targets = zip(*batch)
+        M, B = self.dataset.batch_multiplier, len(batch)
+        shape = self.dataset.view_shape()
+        out = None if shape is None else _batch_buffer((M * B,) + shape).view((M, B) + shape)
+        for i, (index, img, _, _, policy) in enumerate(samples):
+            policies = self.dataset.given_policy if policy is None else policy
+            if out is None:
+                views = self._views(index, img, policies)
+                out = _batch_buffer((M * B,) + views.shape[1:]).view((M, B) + views.shape[1:])
+                out[:, i] = views
+            else:
+                self._views(index, img, policies, out=out[:, i])
+        aug_img = out.view((M * B,) + out.shape[2:])
+        target = torch.tensor(targets, dtype=torch.int64).repeat(M)
+        if samples[0][4] is None:
+            return aug_img, target
+        clean = [sample[2] for sample in samples]
+        if self.dataset.clean_views is not None:
+            clean = torch.tensor(clean, dtype=torch.int64)
+        else:
+            clean = torch.stack(clean, out=_batch_buffer((B,) + clean[0].shape))
+        log_prob = torch.from_numpy(np.stack([sample[3] for sample in samples], 1).reshape(M * B))
+        policy = np.stack([sample[4] for sample in samples], 1)
+        policy = torch.from_numpy(policy.reshape((M * B,) + policy.shape[2:]))
+        return [aug_img, clean, log_prob, policy], target
+
+
+def _probe_policies(controller, n, batch_multiplier=1):
+    """uniformly drawn policies [n, (M,) n_subpolicy, n_op, 3] and log probs of the shape the controller samples"""
+    controller = getattr(controller, 'module', controller)
+    shape = (n,) + ((batch_multiplier,) if batch_multiplier > 1 else ()) + (controller.n_subpolicy, controller.n_op)
+    prob = np.random.randint(controller._operation_prob, size=shape) if controller._operation_prob > 0 else np.full(shape, 10)
+    policies = np.stack([np.random.randint(controller._operation_types, size=shape), prob,
+                         np.random.randint(controller._operation_mag, size=shape)], -1)
+    return policies, np.zeros(shape[:-2], dtype=np.float32)
+
+
+def tune_loader(dataset, name, transform, batch, batch_multiplier=1, modes=(False,), persistent=True, cache_dir=None):
+    """
+    loader_tuner.tune on the train loader of dataset (total_trainset of get_dataloaders).
+    modes: policy stages of an AdapAugData with a controller to compare, False: pre-sampled
+        policies applied per sample in the workers (probed with _probe_policies), True: PolicyStream.
+    persistent: whether persistent_workers is a candidate.
+    Returns (stream, DataLoader settings).
+    """
+    base = dataset.dataset if isinstance(dataset, Subset) else dataset
+    adaptive = isinstance(base, AdapAugData) and base.controller is not None
+    key = '%s|%s|%s' % (name, transform_signature(transform, batch, batch_multiplier, list(modes)), host_signature())
+
+    def make_loader(stream, **settings):
+        if adaptive:
+            base.stream = stream
+            if not stream and base.policies is None:
+                store_policies(base, *_probe_policies(base.controller, len(base), batch_multiplier))
+        if isinstance(base, AdapAugData):
+            base.collate = base.batch_multiplier > 1 and not stream
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch, shuffle=not isinstance(dataset, IterableDataset),
+                                             drop_last=True, collate_fn=ViewCollate(dataset) if getattr(base, 'collate', False) else None,
+                                             **settings)
+        return PolicyStream(loader, base.controller, batch_multiplier) if stream else loader
+
+    try:
+        return tune(make_loader, key, os.path.join(cache_dir, 'settings.json') if cache_dir else None, modes,
+                    persistent=persistent)
+    finally:
+        if isinstance(base, AdapAugData):
+            base.collate = False
+        if adaptive:
+            base.stream = False
+            base.policies = base.log_probs = base.policy_table = None
+
+
+def sample_policies(dataset, controller, batch, batch_multiplier=1):
+    """
+    Controller pre-pass: sample policies and log probs of every sample (and view) of dataset
+    (AdapAugData) from its clean images, and store them in dataset.policies / dataset.log_probs.
+    """
+    dataset.policies = dataset.log_probs = None
+    prev_controller, dataset.controller = dataset.controller, controller
+    with torch.no_grad():
+        temp_loader = torch.utils.data.DataLoader(
+                    dataset, batch_size=batch*batch_multiplier, shuffle=False, num_workers=4,
+                    drop_last=False)
+        policies = []
+        log_probs = []
+        controller.eval()
+        for data, _ in temp_loader:
+            mpolicy = []
+            mlog_prob = []
+            for m in range(batch_multiplier):
+                log_prob, _, sampled_policies = controller(data.cuda())
+                mpolicy.append(sampled_policies.detach().cpu())
+                mlog_prob.append(log_prob.detach().cpu())
+            policies.append(torch.stack(mpolicy)) # [M, datalen, ...]
+            log_probs.append(torch.stack(mlog_prob)) # [M, datalen]
+        policies  = torch.cat(policies, dim=1)
+        log_probs = torch.cat(log_probs, dim=1)
+        if batch_multiplier > 1:
+            store_policies(dataset, policies.permute(1,0,2,3,4).cpu().numpy(), log_probs.T.cpu().numpy())
+        else:
+            store_policies(dataset, policies[0].cpu().numpy(), log_probs[0].cpu().numpy())
+    dataset.controller = prev_controller
+
+
+class DataModule(object):
+    """
+    get_dataloaders built once per run: the datasets, split indices and loaders are kept.
+    set_policies, sample_policies, set_transform and set_split change them in place. Loader
+    workers are started per iteration, so a change takes effect from the next epoch on
+    (persistent workers picked by loader_tune keep their transform; policies are shared).
+    """
+    def __init__(self, dataset, batch, dataroot, split=0.15, split_idx=0, controller=None, batch_multiplier=1, validation=False, **kwargs):
+        self.dataset = dataset
+        self.split_cache_dir = kwargs.get('split_cache')
+        self.batch = batch
+        self.split = split
+        self.split_idx = split_idx
+        self.controller = controller
+        self.batch_multiplier = batch_multiplier
+        self.validation = validation
+        self.train_sampler, self.trainloader, self.validloader, self.testloader = get_dataloaders(
+            dataset, batch, dataroot, split, split_idx, controller=controller, batch_multiplier=batch_multiplier, validation=validation, **kwargs)
+
+    def loaders(self):
+        """(train_sampler, trainloader, validloader, testloader), as get_dataloaders returns them"""
+        return self.train_sampler, self.trainloader, self.validloader, self.testloader
+
+    @property
+    def trainset(self):
+        # total_trainset of get_dataloaders, without Subset / KeyedRNG wrappers
+        dataset = self.validloader.dataset
+        while isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        return dataset
+
+    def set_policies(self, policies, log_probs):
+        """policies: [N, (M,) n_subpolicy, n_op, 3], log_probs: [N, (M)] of every train sample"""
+        store_policies(self.trainset, policies, log_probs)
+
+    def sample_policies(self, controller=None):
+        """re-run the controller pre-pass, with the given controller or the one of the constructor"""
+        if isinstance(self.trainloader, PolicyStream):
+            # sampled per batch
+            if controller is not None:
+                self.trainloader.controller = self.validloader.controller = controller
+            return
+        sample_policies(self.trainset, controller or self.controller, self.batch, self.batch_multiplier)
+
+    def set_transform(self, transform, clean_transform=None):
+        self.trainset.transform = transform
+        if clean_transform is not None:
+            self.trainset.clean_transform = clean_transform
+            if getattr(self.trainset, 'clean_views', None) is not None:
+                self.trainset.clean_views = CleanViews(self.trainset, self.trainset.clean_views.data.dtype) \
+                    if CleanViews.supports(self.trainset) else None
+
+    def set_view_cache(self, view_cache):
+        set_view_cache(self.trainset, view_cache)
+
+    def set_split(self, split_idx):
+        if split_idx == self.split_idx:
+            return
+        if self.dataset == 'reduced_imagenet':
+            raise ValueError('set_split is not supported for %s' % self.dataset)
+        train_idx, valid_idx, test_idx = split_indices(self.dataset, self.trainset, self.split, split_idx, self.validation, cache_dir=self.split_cache_dir)
+        if self.split > 0.0:
+            if self.controller is not None: # Adv AA
+                train_idx = list(train_idx) + list(valid_idx) # D_T + D_V
+            self.train_sampler.indices = train_idx
+            self.validloader.sampler.indices = valid_idx
+            if self.validation:
+                self.testloader.dataset.indices = test_idx
+        elif isinstance(self.validloader.dataset, Subset):
+            self.validloader.dataset.indices = train_idx
+        self.split_idx = split_idx
+
+    def set_epoch(self, epoch):
+        if isinstance(self.trainloader.dataset, KeyedRNG):
+            self.trainloader.dataset.set_epoch(epoch)
+
+
+def set_view_cache(dataset, view_cache):
+    """attach view_cache (ViewCache or None) to dataset (AdapAugData), whose images must have its view shape"""
+    if view_cache is not None and view_cache.shape != dataset.data.shape[1:]:
+        raise ValueError('view cache of %s views for %s images' % (view_cache.shape, dataset.data.shape[1:]))
+    dataset.view_cache = view_cache
+
+
+class KeyedRNG(Dataset):
+    """
+    Runs dataset[index] inside rng.keyed(seed, epoch, index), so every augmentation draw of
+    the sample is a pure function of (seed, epoch, index, view, draw index).
+    Call set_epoch at the start of every epoch.
+    """
+    def __init__(self, dataset, seed, epoch=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = epoch
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        with rng.keyed(self.seed, self.epoch, index):
+            return self.dataset[index]
+
+
 class CutoutDefault(object):
     """
     Reference : https://github.com/quark0/darts/blob/master/cnn/utils.py
@@ -399,8 +970,8 @@ class CutoutDefault(object):
     def __call__(self, img):
         h, w = img.size(1), img.size(2)
         mask = np.ones((h, w), np.float32)
-        y = np.random.randint(h)
-        x = np.random.randint(w)
+        y = rng.np_randint(h)
+        x = rng.np_randint(w)
 
         y1 = np.clip(y - self.length // 2, 0, h)
         y2 = np.clip(y + self.length // 2, 0, h)
@@ -414,24 +985,137 @@ class CutoutDefault(object):
         return img
 
 
+class CropFlipNormalize(object):
+    """
+    RandomCrop(size, padding) -> RandomHorizontalFlip -> ToTensor -> Normalize(mean, std)
+    -> CutoutDefault(cutout) fused into one pass over the uint8 HWC image.
+    Crop and flip are index arithmetic, ToTensor and Normalize one lookup table per channel,
+    cutout a slice fill. The random draws are the same as those of the separate transforms,
+    in the same order, so the output is identical.
+    """
+    def __init__(self, size, padding, mean, std, cutout=0):
+        self.size = size
+        self.padding = padding
+        self.cutout = cutout
+        ix = torch.arange(256, dtype=torch.float32).div(255).view(1, 256)
+        mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(-1, 1)
+        self.lut = ix.sub(mean).div(std).numpy()     # [C, 256], lut[:, 0] is the padding value
+
+    def output_shape(self):
+        return (len(self.lut), self.size, self.size)
+
+    def __call__(self, img, out=None):
+        """
+        img: PIL Image or uint8 array [H, W, C]
+        out: (tensor) float32 [C, size, size] to write into, optional
+        """
+        arr = np.asarray(img)
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        h, w = arr.shape[:2]
+        s, p = self.size, self.padding
+        # transforms.RandomCrop.get_params on the padded image
+        if h + 2 * p == s and w + 2 * p == s:
+            i = j = 0
+        else:
+            i = rng.torch_randint(0, h + 2 * p - s + 1)
+            j = rng.torch_randint(0, w + 2 * p - s + 1)
+        flip = rng.torch_rand() < 0.5
+
+        # rows / columns of the crop window that fall on the image
+        r0, r1 = max(0, i - p), min(h, i - p + s)
+        c0, c1 = max(0, j - p), min(w, j - p + s)
+        y0, x0 = r0 - (i - p), c0 - (j - p)
+        y1, x1 = y0 + r1 - r0, x0 + c1 - c0
+        src = arr[r0:r1, c0:c1]
+        if flip:
+            src = src[:, ::-1]
+            x0, x1 = s - x1, s - x0
+
+        if out is None:
+            out = torch.empty(self.output_shape(), dtype=torch.float32)
+        o = out.numpy()
+        full = y0 == 0 and x0 == 0 and y1 == s and x1 == s
+        for c, lut in enumerate(self.lut):
+            if not full:
+                o[c].fill(lut[0])
+            np.take(lut, src[:, :, c], out=o[c, y0:y1, x0:x1], mode='clip')
+
+        if self.cutout > 0:
+            # same draws as CutoutDefault
+            y = rng.np_randint(s)
+            x = rng.np_randint(s)
+            y1, y2 = np.clip(y - self.cutout // 2, 0, s), np.clip(y + self.cutout // 2, 0, s)
+            x1, x2 = np.clip(x - self.cutout // 2, 0, s), np.clip(x + self.cutout // 2, 0, s)
+            o[:, y1:y2, x1:x2] = 0.
+        return out
+
+    def batch(self, imgs):
+        """
+        Batched counterpart for the batch-level stage of PolicyStream: every sample draws its
+        own crop, flip and cutout, from torch instead of the rng module.
+        imgs: (tensor) uint8 [N, C, H, W]
+        return: (tensor) float32 [N, C, size, size]
+        """
+        n, c, h, w = imgs.shape
+        s, p = self.size, self.padding
+        padded = torch.nn.functional.pad(imgs, (p, p, p, p))
+        i = torch.randint(0, h + 2 * p - s + 1, (n,))
+        j = torch.randint(0, w + 2 * p - s + 1, (n,))
+        flip = torch.rand(n) < 0.5
+        ar = torch.arange(s)
+        rows = i[:, None] + ar
+        cols = j[:, None] + torch.where(flip[:, None], s - 1 - ar, ar)
+        crops = padded[torch.arange(n)[:, None, None], :, rows[:, :, None], cols[:, None, :]]   # [N, s, s, C]
+        out = torch.from_numpy(self.lut)[torch.arange(c), crops.long()].permute(0, 3, 1, 2).contiguous()
+        if self.cutout > 0:
+            y = torch.randint(s, (n, 1))
+            x = torch.randint(s, (n, 1))
+            half = self.cutout // 2
+            ym = (ar >= (y - half).clamp(0, s)) & (ar < (y + half).clamp(0, s))
+            xm = (ar >= (x - half).clamp(0, s)) & (ar < (x + half).clamp(0, s))
+            out.masked_fill_(ym[:, None, :, None] & xm[:, None, None, :], 0.)
+        return out
+
+
 class Augmentation(object):
     def __init__(self, policies):
         self.policies = policies
 
-    def __call__(self, img):
+    def __call__(self, img, ctx=None, cache=None, index=None):
+        """
+        ctx: (EnhanceContext) shared by the views of the same source image, optional
+        cache: (ViewCache) of augmented views, optional. index: dataset index of img, needed with cache
+        """
         for _ in range(1):
-            policy = random.choice(self.policies)
+            policy = rng.choice(self.policies)
+            ops = []
             for name, pr, level in policy:
                 if type(name) != str:
                     name, pr, level = (op_list[name][0].__name__, pr/10., level/10.+.1)
-                if random.random() > pr:
+                if rng.random() > pr:
                     continue
-                img = apply_augment(img, name, level)
+                ops.append((name, level))
+            # the ops draw from their own stream: a cache hit that skips them leaves later draws unchanged
+            with rng.stream(1):
+                key = cache_key(index, ops) if cache is not None and ops else None
+                view = cache.get(key) if key is not None else None
+                if view is not None:
+                    img = Image.fromarray(view)
+                else:
+                    img = apply_augments(img, ops, ctx)
+                    if key is not None:
+                        cache.put(key, np.asarray(img))
             self.policy = policy
         return img
 
 class EfficientNetRandomCrop:
-    def __init__(self, imgsize, min_covered=0.1, aspect_ratio_range=(3./4, 4./3), area_range=(0.08, 1.0), max_attempts=10):
+    """
+    resize=True: resize the crop to (imgsize, imgsize) bicubic in the same resample as the crop,
+    close to but not bit exact with crop + Resize (see benchmark.bench_crops for measured differences)
+    """
+    def __init__(self, imgsize, min_covered=0.1, aspect_ratio_range=(3./4, 4./3), area_range=(0.08, 1.0), max_attempts=10, resize=False):
         assert 0.0 < min_covered
         assert 0 < aspect_ratio_range[0] <= aspect_ratio_range[1]
         assert 0 < area_range[0] <= area_range[1]
@@ -441,7 +1125,9 @@ class EfficientNetRandomCrop:
         self.aspect_ratio_range = aspect_ratio_range
         self.area_range = area_range
         self.max_attempts = max_attempts
-        self._fallback = EfficientNetCenterCrop(imgsize)
+        self._fallback = EfficientNetCenterCrop(imgsize, resize=resize)
+        self.output_size = (imgsize, imgsize) if resize else None
+        self.draft_size, self.draft_margin = None, 1.
 
     def __call__(self, img):
         # https://github.com/tensorflow/tensorflow/blob/9274bcebb31322370139467039034f8ff852b004/tensorflow/core/kernels/sample_distorted_bounding_box_op.cc#L111
@@ -450,7 +1136,7 @@ class EfficientNetRandomCrop:
         max_area = self.area_range[1] * (original_width * original_height)
 
         for _ in range(self.max_attempts):
-            aspect_ratio = random.uniform(*self.aspect_ratio_range)
+            aspect_ratio = rng.uniform(*self.aspect_ratio_range)
             height = int(round(math.sqrt(min_area / aspect_ratio)))
             max_height = int(round(math.sqrt(max_area / aspect_ratio)))
 
@@ -466,7 +1152,7 @@ class EfficientNetRandomCrop:
             if height >= max_height:
                 height = max_height
 
-            height = int(round(random.uniform(height, max_height)))
+            height = int(round(rng.uniform(height, max_height)))
             width = int(round(height * aspect_ratio))
             area = width * height
 
@@ -479,16 +1165,23 @@ class EfficientNetRandomCrop:
             if width == original_width and height == original_height:
                 return self._fallback(img)      # https://github.com/tensorflow/tpu/blob/master/models/official/efficientnet/preprocessing.py#L102
 
-            x = random.randint(0, original_width - width)
-            y = random.randint(0, original_height - height)
-            return img.crop((x, y, x + width, y + height))
+            x = rng.randint(0, original_width - width)
+            y = rng.randint(0, original_height - height)
+            return draft_crop(img, (x, y, x + width, y + height), self.draft_size, self.draft_margin, self.output_size)
 
         return self._fallback(img)
 
+    def set_draft(self, size, margin):
+        self.draft_size, self.draft_margin = size, margin
+        self._fallback.set_draft(size, margin)
+
 
 class EfficientNetCenterCrop:
-    def __init__(self, imgsize):
+    """resize=True: resize the crop to (imgsize, imgsize) bicubic in the same resample as the crop"""
+    def __init__(self, imgsize, resize=False):
         self.imgsize = imgsize
+        self.output_size = (imgsize, imgsize) if resize else None
+        self.draft_size, self.draft_margin = None, 1.
 
     def __call__(self, img):
         """Crop the given PIL Image and resize it to desired size.
@@ -508,7 +1201,36 @@ class EfficientNetCenterCrop:
         crop_height, crop_width = crop_size, crop_size
         crop_top = int(round((image_height - crop_height) / 2.))
         crop_left = int(round((image_width - crop_width) / 2.))
-        return img.crop((crop_left, crop_top, crop_left + crop_width, crop_top + crop_height))
+        return draft_crop(img, (crop_left, crop_top, crop_left + crop_width, crop_top + crop_height), self.draft_size, self.draft_margin, self.output_size)
+
+    def set_draft(self, size, margin):
+        self.draft_size, self.draft_margin = size, margin
+
+
+def draft_crop(img, box, size=None, margin=1., resize=None):
+    """
+    img.crop(box) in RGB. A JPEG not decoded yet (opened by imagenet.lazy_loader) is decoded at the
+    largest 1/2, 1/4 or 1/8 DCT-domain reduction that keeps the crop at least margin * size,
+    the (width, height) of the following Resize, and the box is scaled along.
+    resize: (width, height), crop and bicubic resize in a single resample of the source box
+    """
+    width, height = img.size
+    if size is not None and img.format == 'JPEG' and getattr(img, 'tile', None):
+        scale = min((box[2] - box[0]) / (margin * size[0]), (box[3] - box[1]) / (margin * size[1]))
+        if scale >= 2:
+            # draft picks a reduction of at most width / requested width
+            img.draft('RGB', (int(math.ceil(width / scale)), int(math.ceil(height / scale))))
+            rx, ry = img.size[0] / width, img.size[1] / height
+            box = (box[0] * rx, box[1] * ry, box[2] * rx, box[3] * ry)
+    if resize is not None:
+        if img.size == (width, height):
+            # not drafted: the same pixels as img.crop, which rounds the box
+            box = tuple(int(round(v)) for v in box)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img.resize(resize, Image.BICUBIC, box=box)
+    img = img.crop(box)
+    return img if img.mode == 'RGB' else img.convert('RGB')
 
 
 class SubsetSampler(Sampler):
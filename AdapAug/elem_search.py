@@ -160,6 +160,14 @@ if __name__ == '__main__':
     parser.add_argument('--no_img', action='store_true')
     parser.add_argument('--r_type', type=int, default=1)
     parser.add_argument('--validation', action='store_true')
+    parser.add_argument('--view_cache', type=int, default=0, help='MB of shared memory for augmented views (0: off)')
+    parser.add_argument('--stream_policies', nargs='?', const='on', default='off', choices=['off', 'on', 'auto'],
+                        help='sample policies per batch instead of a pre-pass (auto: chosen by --loader_tune)')
+    parser.add_argument('--loader_tune', action='store_true', help='probe and cache the DataLoader settings of this host')
+    parser.add_argument('--resident_eval', type=str, default=None, choices=['float32', 'float16'], help='keep the test set normalized in memory')
+    parser.add_argument('--clean_cache', type=str, default=None, choices=['float32', 'float16'], help='compute the clean train views once, in shared memory')
+    parser.add_argument('--rng_seed', type=int, default=None, help='key the train augmentation draws by (seed, epoch, sample)')
+    parser.add_argument('--split_cache', type=str, default=None, help='folder to cache the split indices in (default: off)')
 
 
     args = parser.parse_args()
@@ -240,6 +248,10 @@ if __name__ == '__main__':
             'ctl_train_steps': args.c_step, 'aff_step': args.a_step, 'div_step': args.d_step, # version 2
             'aff_w': args.aw, 'div_w': args.dw, 'ctl_entropy_w': args.ew, 'reward_type': args.r_type, # version 3
             'ctl_num_aggre': args.c_agg, "M": args.M, 'validation': args.validation,
+            'view_cache': args.view_cache, 'stream_policies': {'off': False, 'on': True, 'auto': 'auto'}[args.stream_policies],
+            'loader_tune': args.loader_tune, 'resident_eval': args.resident_eval,
+            'clean_cache': args.clean_cache, 'rng_seed': args.rng_seed,
+            'split_cache': args.split_cache,
     }
     if args.version == 2:
         # epoch-wise alternating training
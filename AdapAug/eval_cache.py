@@ -0,0 +1,128 @@
+# deterministic eval sets (ToTensor + Normalize of uint8 image arrays: the CIFAR / SVHN test splits)
+# normalized once into one contiguous tensor, which the eval loops go through by slicing,
+# with no decoding and no loader workers; the clean views of the train samples likewise.
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from torchvision.transforms import transforms
+
+
+def _normalization(transform):
+    """(mean, std) when transform is Compose([ToTensor(), Normalize(mean, std)]), else None"""
+    ts = getattr(transform, 'transforms', None)
+    if ts is None or len(ts) != 2 or not isinstance(ts[0], transforms.ToTensor) or not isinstance(ts[1], transforms.Normalize):
+        return None
+    return ts[1].mean, ts[1].std
+
+
+def _normalize_into(out, data, nchw, mean, std, indices=None, chunk=1024):
+    """out[i] = Normalize(mean, std)(ToTensor()(data[indices[i]])), bit for bit in float32"""
+    mean = torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+    std = torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+    for s in range(0, len(out), chunk):
+        block = torch.from_numpy(np.ascontiguousarray(data[s:s + chunk] if indices is None else data[indices[s:s + chunk]]))
+        if not nchw:
+            block = block.permute(0, 3, 1, 2)
+        # the operations of ToTensor and Normalize, in their order
+        out[s:s + len(block)] = block.float().div_(255).sub_(mean).div_(std)
+    return out
+
+
+def _image_shape(data, nchw):
+    return tuple(data.shape[1:]) if nchw else (data.shape[3],) + tuple(data.shape[1:3])
+
+
+def resident_source(dataset):
+    """
+    (data, nchw, targets, indices, (mean, std)) of dataset (optionally a Subset) when every sample
+    is transform(data[index]) with a ToTensor + Normalize transform, None otherwise.
+    data: uint8 [N, H, W, C] or [N, C, H, W] (nchw, torchvision SVHN), told apart by the channel axis,
+    indices: those of the Subset or None
+    """
+    indices = None
+    if isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        dataset = dataset.dataset
+    norm = _normalization(getattr(dataset, 'transform', None))
+    data = getattr(dataset, 'data', None)
+    if norm is None or not isinstance(data, np.ndarray) or data.dtype != np.uint8 or data.ndim != 4:
+        return None
+    if getattr(dataset, 'target_transform', None) is not None:
+        return None
+    # AdapAugData applies the transform alone only without controller, policies and extra views
+    if getattr(dataset, 'controller', None) is not None or getattr(dataset, 'policies', None) is not None \
+            or getattr(dataset, 'batch_multiplier', 1) > 1:
+        return None
+    nchw = data.shape[3] not in (1, 3)
+    targets = dataset.targets if hasattr(dataset, 'targets') else dataset.labels
+    return data, nchw, targets, indices, norm
+
+
+class ResidentLoader(object):
+    """
+    Loader of an eval dataset accepted by resident_source, held normalized in one contiguous
+    [N, C, H, W] tensor, float32 (the values of the transform, bit for bit) or float16 (cast back
+    per batch). Batches are slices, in order, as a DataLoader without shuffle and drop_last.
+    When dataset is a Subset whose indices changed (DataModule.set_split), the tensor is
+    rebuilt on the next iteration.
+    """
+    def __init__(self, dataset, batch_size, dtype=torch.float32, chunk=1024):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.chunk = chunk
+        self._build()
+
+    def _build(self):
+        data, nchw, targets, indices, (mean, std) = resident_source(self.dataset)
+        self.indices = indices
+        n = len(data) if indices is None else len(indices)
+        self.data = torch.empty((n,) + _image_shape(data, nchw), dtype=self.dtype, pin_memory=torch.cuda.is_available())
+        _normalize_into(self.data, data, nchw, mean, std, indices, self.chunk)
+        targets = np.asarray(targets, dtype=np.int64)
+        self.targets = torch.from_numpy(targets if indices is None else targets[indices])
+
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
+
+    def __len__(self):
+        return math.ceil(len(self.data) / self.batch_size)
+
+    def __iter__(self):
+        if isinstance(self.dataset, Subset) and not np.array_equal(self.indices, self.dataset.indices):
+            self._build()
+        for s in range(0, len(self.data), self.batch_size):
+            yield self.data[s:s + self.batch_size].float(), self.targets[s:s + self.batch_size]
+
+
+class CleanViews(object):
+    """
+    clean_transform (ToTensor + Normalize) of every sample of an AdapAugData, computed once into a
+    shared-memory [N, C, H, W] tensor, float32 or float16, read by every DataLoader worker.
+    views[indices]: float32 clean images of the samples, a tensor of indices or an int.
+    """
+    def __init__(self, dataset, dtype=torch.float32):
+        mean, std = _normalization(dataset.clean_transform)
+        self.data = torch.empty((len(dataset.data),) + _image_shape(dataset.data, False), dtype=dtype).share_memory_()
+        _normalize_into(self.data, dataset.data, False, mean, std)
+
+    @staticmethod
+    def supports(dataset):
+        data = getattr(dataset, 'data', None)
+        return _normalization(getattr(dataset, 'clean_transform', None)) is not None \
+            and isinstance(data, np.ndarray) and data.dtype == np.uint8 and data.ndim == 4
+
+    def __deepcopy__(self, memo):
+        # shared by design, as ViewCache
+        return self
+
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, indices):
+        return self.data[indices].float()
@@ -209,12 +209,17 @@ class GrSpliter(object):
         end_epoch = min(start_epoch + len_epoch, C.get()['epoch']+1)
         total_t_train_time = 0
         total_g_train_time = 0
+        # loaders are built once, the policy is fixed for the whole call
+        C.get()["aug"] = policy
+        _, t_dataloader, _, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, gr_assign=self.gr_assign)
+        C.get()["aug"] = "clean"
+        _, g_dataloader, _ , _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0)#, split_idx=cv_id, rand_val=True)
         for epoch in range(start_epoch, end_epoch):
             # train TargetNetwork
             t_net.train()
             C.get()["aug"] = policy
             ts = time.time()
-            _, dataloader, _, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, gr_assign=self.gr_assign)
+            dataloader = t_dataloader
             metrics = run_epoch(t_net, dataloader, self.t_loss_fn, t_optimizer, desc_default='T-train', epoch=epoch, scheduler=t_scheduler, wd=C.get()['optimizer']['decay'], verbose=False)
             total_t_train_time += time.time() - ts
             print(f"[T-train] {epoch}/{end_epoch} (time {total_t_train_time:.1f}) {metrics}")
@@ -222,7 +227,7 @@ class GrSpliter(object):
             t_net.eval()
             C.get()["aug"] = "clean"
             gs = time.time()
-            _, dataloader, _ , _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0)#, split_idx=cv_id, rand_val=True)
+            dataloader = g_dataloader
             for step, (data, label) in enumerate(dataloader):
                 data, label = data.cuda(), label.cuda()
                 # data split
@@ -1,7 +1,9 @@
 from __future__ import print_function
 import os
 import shutil
+import numpy as np
 import torch
+from PIL import Image
 
 ARCHIVE_DICT = {
     'train': {
@@ -39,6 +41,8 @@ class ImageNet(torchvision.datasets.ImageFolder):
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         loader (callable, optional): A function to load an image given its path.
+        index (bool, optional): If true and root/index holds the memory-mapped index of split
+            (see SampleIndex, built by ``python -m AdapAug.imagenet``), samples and targets are read from it.
 
      Attributes:
         classes (list): List of the class names.
@@ -49,7 +53,7 @@ class ImageNet(torchvision.datasets.ImageFolder):
         targets (list): The class_index value for each image in the dataset
     """
 
-    def __init__(self, root, split='train', download=False, **kwargs):
+    def __init__(self, root, split='train', download=False, index=True, **kwargs):
         root = self.root = os.path.expanduser(root)
         self.split = self._verify_split(split)
 
@@ -59,7 +63,18 @@ class ImageNet(torchvision.datasets.ImageFolder):
 
         # to skip os walk (it's too slow) using ILSVRC/ImageSets/CLS-LOC/train_cls.txt file
         listfile = os.path.join(root, 'train_cls.txt')
-        if split == 'train' and os.path.exists(listfile):
+        if index and has_index(root, self.split):
+            torchvision.datasets.VisionDataset.__init__(self, root, **kwargs)
+            self.loader = torchvision.datasets.folder.default_loader
+            self.extensions = torchvision.datasets.folder.IMG_EXTENSIONS
+
+            self.classes = load_index_classes(root, self.split)
+            self.class_to_idx = {self.classes[i]: i for i in range(len(self.classes))}
+            self.samples = SampleIndex(root, self.split, self.split_folder)
+            self.targets = self.samples.labels
+
+            self.imgs = self.samples
+        elif split == 'train' and os.path.exists(listfile):
             torchvision.datasets.VisionDataset.__init__(self, root, **kwargs)
             with open(listfile, 'r') as f:
                 datalist = [
@@ -91,7 +106,8 @@ class ImageNet(torchvision.datasets.ImageFolder):
 
         self.root = root
 
-        idcs = [idx for _, idx in self.imgs]
+        # only the first len(classes) labels are paired below
+        idcs = [int(idx) for idx in self.targets[:len(self.classes)]]
         self.wnids = self.classes
         self.wnid_to_idx = {wnid: idx for idx, wnid in zip(idcs, self.wnids)}
         self.classes = [wnid_to_classes[wnid] for wnid in self.wnids]
@@ -99,6 +115,33 @@ class ImageNet(torchvision.datasets.ImageFolder):
                              for clss, idx in zip(self.classes, idcs)
                              for cls in clss}
 
+    def __getstate__(self):
+        # DataLoader workers: the targets of an index are its labels, re-mapped with it
+        state = self.__dict__.copy()
+        if isinstance(self.samples, SampleIndex):
+            del state['targets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.samples, SampleIndex):
+            self.targets = self.samples.labels
+
+    def relabel(self, mask, labels):
+        """Set the labels of the samples selected by the boolean mask (reduced_imagenet)"""
+        if isinstance(self.samples, SampleIndex):
+            self.samples.set_labels(mask, labels)
+        else:
+            targets = np.array(self.targets, dtype=np.int64)
+            targets[mask] = labels
+            self.samples = self.imgs = [(p, lb) for (p, _), lb in zip(self.samples, targets.tolist())]
+            self.targets = targets.tolist()
+
+    def set_draft(self, margin):
+        """Decode JPEGs at a reduced scale in the crop starting the transform (see set_draft)"""
+        if set_draft(self.transform, margin):
+            self.loader = lazy_loader
+
     def download(self):
         if not check_integrity(self.meta_file):
             tmpdir = os.path.join(self.root, 'tmp')
@@ -162,6 +205,129 @@ class ImageNet(torchvision.datasets.ImageFolder):
         return "Split: {split}".format(**self.__dict__)
 
 
+def lazy_loader(path):
+    # decoded by the first transform (data.draft_crop), possibly at a reduced scale
+    return Image.open(path)
+
+
+def set_draft(transform, margin):
+    """
+    If transform is a Compose starting with a crop (EfficientNetRandomCrop / EfficientNetCenterCrop)
+    that resizes itself or is followed by a Resize, let the crop decode JPEGs at the largest DCT reduction
+    that keeps it at least margin times the output. Returns whether it applies; images must then be opened lazily.
+    """
+    ts = getattr(transform, 'transforms', [])
+    if not ts or not hasattr(ts[0], 'set_draft'):
+        return False
+    size = getattr(ts[0], 'output_size', None)
+    if size is None:
+        if len(ts) < 2 or not isinstance(ts[1], torchvision.transforms.Resize):
+            return False
+        size = ts[1].size
+        size = (size, size) if isinstance(size, int) else (size[1], size[0])
+    ts[0].set_draft(size, margin)
+    return True
+
+
+def index_path(root, split):
+    return os.path.join(root, 'index', split)
+
+
+def has_index(root, split):
+    path = index_path(root, split)
+    return all(os.path.isfile(path + '_%s.npy' % name) for name in ('paths', 'offsets', 'labels', 'classes'))
+
+
+def load_index_classes(root, split):
+    return np.load(index_path(root, split) + '_classes.npy').tolist()
+
+
+def save_index(root, split, samples, classes, folder):
+    """
+    Write samples, a list of (path, class_index), as the binary index of split:
+    one utf-8 blob of the paths relative to folder, int64 offsets into it, int16 labels.
+    """
+    path = index_path(root, split)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    prefix = folder + os.sep
+    paths = [(p[len(prefix):] if p.startswith(prefix) else p).encode('utf-8') for p, _ in samples]
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in paths], out=offsets[1:])
+    arrays = {
+        'paths': np.frombuffer(b''.join(paths), dtype=np.uint8),
+        'offsets': offsets,
+        'labels': np.array([lb for _, lb in samples], dtype=np.int16),
+        'classes': np.array(classes),
+    }
+    # write to temporary files and rename, so readers never see a partial index
+    for name, array in arrays.items():
+        np.save(path + '_%s.tmp.npy' % name, array)
+    for name in arrays:
+        os.replace(path + '_%s.tmp.npy' % name, path + '_%s.npy' % name)
+
+
+class SampleIndex(object):
+    """
+    Sequence of (path, class_index) read from the memory-mapped index, in place of the samples
+    list of ImageFolder: the paths and labels are shared through the page cache instead of
+    being held as python objects by every process.
+    """
+    def __init__(self, root, split, folder):
+        self.root = root
+        self.split = split
+        self.folder = folder
+        self.relabeled = False
+        self._load()
+
+    def _load(self):
+        path = index_path(self.root, self.split)
+        self.paths = np.load(path + '_paths.npy', mmap_mode='r')
+        self.offsets = np.load(path + '_offsets.npy', mmap_mode='r')
+        if not self.relabeled:
+            # copy-on-write: relabeling (reduced_imagenet) never touches the file
+            self.labels = np.load(path + '_labels.npy', mmap_mode='c')
+
+    def __getstate__(self):
+        # re-map in the receiving process, labels are only sent once they were changed
+        state = self.__dict__.copy()
+        for k in ('paths', 'offsets') if self.relabeled else ('paths', 'offsets', 'labels'):
+            del state[k]
+        if self.relabeled:
+            state['labels'] = np.array(self.labels)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def path(self, index):
+        s, e = self.offsets[index], self.offsets[index + 1]
+        return os.path.join(self.folder, self.paths[s:e].tobytes().decode('utf-8'))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.path(index), int(self.labels[index])
+
+    def __setitem__(self, index, sample):
+        # only the label of a sample can change, its path is fixed by the index
+        self.set_labels(index, sample[1])
+
+    def set_labels(self, index, labels):
+        # one assignment to the label column, index an int, indices or a boolean mask
+        self.labels[index] = labels
+        self.relabeled = True
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 def extract_tar(src, dest=None, gzip=None, delete=False):
     import tarfile
 
@@ -243,3 +409,38 @@ def _splitexts(root):
         root, ext = os.path.splitext(root)
         exts.append(ext)
     return root, ''.join(reversed(exts))
+
+
+def _load_report(root, split, index):
+    import pickle
+    import time
+    import tracemalloc
+
+    t = time.time()
+    dataset = ImageNet(root, split=split, index=index)
+    elapsed = time.time() - t
+    tracemalloc.start()
+    dataset = ImageNet(root, split=split, index=index)
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return dataset, elapsed, heap, len(pickle.dumps(dataset.samples))
+
+
+if __name__ == '__main__':
+    # build the sample index and report startup time and memory against the list of tuples:
+    #   python -m AdapAug.imagenet --root /data/private/pretrainedmodels/imagenet-pytorch
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='imagenet-pytorch folder')
+    parser.add_argument('--split', type=str, nargs='+', default=['train', 'val'])
+    args = parser.parse_args()
+
+    for split in args.split:
+        dataset, elapsed, heap, pickled = _load_report(args.root, split, index=False)
+        save_index(args.root, split, dataset.samples, dataset.wnids, dataset.split_folder)
+        print('%s list : %d samples, startup %.2fs, heap %.1fMB, pickled to each worker %.1fMB'
+              % (split, len(dataset), elapsed, heap / 2 ** 20, pickled / 2 ** 20))
+        dataset, elapsed, heap, pickled = _load_report(args.root, split, index=True)
+        mapped = sum(a.nbytes for a in (dataset.samples.paths, dataset.samples.offsets, dataset.samples.labels))
+        print('%s index: %d samples, startup %.2fs, heap %.1fMB, pickled to each worker %.1fMB, mapped (shared) %.1fMB'
+              % (split, len(dataset), elapsed, heap / 2 ** 20, pickled / 2 ** 20, mapped / 2 ** 20))
@@ -0,0 +1,166 @@
+# ImageNet splits packed into large shard files of concatenated encoded JPEG bytes, read sequentially
+# instead of one small file per sample. pack once:
+#   python -m AdapAug.imagenet_shards --root /data/private/pretrainedmodels/imagenet-pytorch --split train val
+# <root>/shards/<split>_00000.bin   encoded images
+# <root>/shards/<split>_00000.npz   offsets (int64 [n + 1]) and labels (int16 [n]) of the shard
+# <root>/shards/<split>.npy         number of records of every shard, written last
+import argparse
+import io
+import os
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+from AdapAug.imagenet import ImageNet, set_draft
+
+
+def shard_path(root, split, shard=None):
+    if shard is None:
+        return os.path.join(root, 'shards', split)
+    return os.path.join(root, 'shards', '%s_%05d' % (split, shard))
+
+
+def has_shards(root, split):
+    return os.path.isfile(shard_path(root, split) + '.npy')
+
+
+def pack(root, split, shard_bytes=1 << 30, seed=0):
+    """
+    Pack the ImageNet split of root into shards of about shard_bytes, in a fixed random order
+    so every shard holds a mix of classes. Returns the number of records of every shard.
+    """
+    dataset = ImageNet(root, split=split)
+    os.makedirs(os.path.dirname(shard_path(root, split)), exist_ok=True)
+    counts = []
+    f, offsets, labels = None, [], []
+
+    def close():
+        f.close()
+        path = shard_path(root, split, len(counts))
+        np.savez(path + '.tmp.npz', offsets=np.array(offsets, dtype=np.int64), labels=np.array(labels, dtype=np.int16))
+        os.replace(path + '.tmp.npz', path + '.npz')
+        os.replace(path + '.tmp.bin', path + '.bin')
+        counts.append(len(labels))
+
+    for idx in np.random.RandomState(seed).permutation(len(dataset)).tolist():
+        if f is None:
+            f, offsets, labels = open(shard_path(root, split, len(counts)) + '.tmp.bin', 'wb'), [0], []
+        path, label = dataset.samples[idx]
+        with open(path, 'rb') as img:
+            offsets.append(offsets[-1] + f.write(img.read()))
+        labels.append(label)
+        if offsets[-1] >= shard_bytes:
+            close()
+            f = None
+    if f is not None:
+        close()
+    np.save(shard_path(root, split) + '.tmp.npy', np.array(counts, dtype=np.int64))
+    os.replace(shard_path(root, split) + '.tmp.npy', shard_path(root, split) + '.npy')
+    return counts
+
+
+class ShardedImageNet(IterableDataset):
+    """
+    Stream of (image, label) of a packed ImageNet split. Rank r of world_size reads the shards
+    r, r + world_size, ..., so len() is the exact number of records of this rank; every epoch
+    hands them to the DataLoader workers in a new random order, read front to back, with the
+    samples shuffled within a buffer of buffer_size encoded records.
+    label_map: (array, optional) new label of every ImageNet class, -1 to drop the class.
+        The records of dropped classes are skipped without being read (reduced_imagenet).
+    """
+    def __init__(self, root, split='train', transform=None, target_transform=None, label_map=None,
+                 shuffle=True, buffer_size=2048, seed=0, rank=0, world_size=1):
+        self.root = root
+        self.split = split
+        self.transform = transform
+        self.target_transform = target_transform
+        self.label_map = None if label_map is None else np.asarray(label_map, dtype=np.int64)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.draft = False
+        self.counts = np.load(shard_path(root, split) + '.npy')
+        self.shards = np.arange(len(self.counts))[rank::world_size]
+        if self.label_map is None:
+            self.n_records = int(self.counts[self.shards].sum())
+        else:
+            self.n_records = sum(int((self.label_map[self._index(s)[1]] >= 0).sum()) for s in self.shards.tolist())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_draft(self, margin):
+        """Decode JPEGs at a reduced scale in the crop starting the transform (see imagenet.set_draft)"""
+        self.draft = set_draft(self.transform, margin)
+
+    def __len__(self):
+        return self.n_records
+
+    def _index(self, shard):
+        with np.load(shard_path(self.root, self.split, shard) + '.npz') as index:
+            return index['offsets'], index['labels']
+
+    def _records(self, shard):
+        """(encoded image, label) of the kept records of shard, in file order"""
+        offsets, labels = self._index(shard)
+        labels = labels.astype(np.int64)
+        if self.label_map is not None:
+            labels = self.label_map[labels]
+        with open(shard_path(self.root, self.split, shard) + '.bin', 'rb') as f:
+            pos = 0
+            for i in np.flatnonzero(labels >= 0).tolist():
+                if offsets[i] != pos:
+                    f.seek(offsets[i])
+                yield f.read(offsets[i + 1] - offsets[i]), int(labels[i])
+                pos = offsets[i + 1]
+
+    def _sample(self, record):
+        data, target = record
+        img = Image.open(io.BytesIO(data))
+        if not self.draft:
+            img = img.convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        shards = self.shards
+        if self.shuffle:
+            shards = np.random.RandomState([self.seed, self.epoch, self.rank]).permutation(shards)
+        shards = shards[worker_id::num_workers].tolist()
+        rs = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+
+        buffer = []
+        for shard in shards:
+            for record in self._records(shard):
+                if not self.shuffle:
+                    yield self._sample(record)
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(record)
+                else:
+                    j = rs.randint(len(buffer))
+                    yield self._sample(buffer[j])
+                    buffer[j] = record
+        rs.shuffle(buffer)
+        for record in buffer:
+            yield self._sample(record)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='imagenet-pytorch folder')
+    parser.add_argument('--split', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--shard-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    for split in args.split:
+        counts = pack(args.root, split, shard_bytes=args.shard_mb << 20)
+        print('%s: %d records -> %d shards in %s' % (split, sum(counts), len(counts), os.path.dirname(shard_path(args.root, split))))
@@ -0,0 +1,117 @@
+# opt-in DataLoader tuning: a short probe of the real train pipeline for candidate
+# (num_workers, prefetch_factor, persistent_workers, pin_memory) settings and policy stages,
+# the best one cached per (dataset, transform signature, host) in a json file.
+import hashlib
+import json
+import os
+import platform
+import time
+
+import torch
+
+from AdapAug.common import get_logger
+
+logger = get_logger('AdapAug')
+
+default_settings = {'num_workers': 8 if torch.cuda.device_count() == 8 else 4, 'prefetch_factor': 2,
+                    'persistent_workers': False, 'pin_memory': True}
+
+
+def host_signature():
+    return '%s/%dcpu/%dgpu' % (platform.node(), os.cpu_count() or 1, torch.cuda.device_count())
+
+
+def _describe(obj):
+    # type and plain attributes; object reprs would carry memory addresses
+    if hasattr(obj, 'transforms'):
+        return [_describe(t) for t in obj.transforms]
+    attrs = {k: v for k, v in sorted(vars(obj).items()) if isinstance(v, (bool, int, float, str, tuple, list))} \
+        if hasattr(obj, '__dict__') else {}
+    return [type(obj).__name__, repr(attrs)]
+
+
+def transform_signature(transform, *extra):
+    """short hash of the transform pipeline and of any other plain values the throughput depends on"""
+    return hashlib.blake2b(repr([_describe(transform), extra]).encode(), digest_size=8).hexdigest()
+
+
+def load_cache(path):
+    if path is None or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(path, key, result):
+    try:
+        cache = load_cache(path)
+        cache[key] = result
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug('loader settings not cached: %s' % e)
+
+
+def probe(loader, batches):
+    """
+    samples/sec of two passes of at most batches batches, each from a fresh iterator:
+    the second pass shows the worker startup that persistent_workers saves
+    """
+    n = 0
+    t = time.perf_counter()
+    for _ in range(2):
+        for i, (data, target) in enumerate(loader):
+            if torch.cuda.is_available():
+                # host to device copy, where pin_memory pays off
+                (data[0] if isinstance(data, list) else data).cuda(non_blocking=True)
+            n += len(target)
+            if i + 1 >= batches:
+                break
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return n / (time.perf_counter() - t)
+
+
+def candidates(persistent=True):
+    cpus = os.cpu_count() or 1
+    return {
+        'num_workers': sorted({w for w in (2, 4, 8, 12, 16, 24, 32) if w <= cpus} | {min(cpus, 4)}),
+        'prefetch_factor': [2, 4, 8],
+        'persistent_workers': [False, True] if persistent else [False],
+        'pin_memory': [True, False] if torch.cuda.is_available() else [False],
+    }
+
+
+def tune(make_loader, key, cache_path=None, modes=(None,), persistent=True, batches=10):
+    """
+    Coordinate search over candidates() for every mode, one setting at a time from default_settings.
+    make_loader(mode, **settings): the train loader (or PolicyStream) to probe.
+    persistent: False when the dataset changes per epoch in the workers (set_epoch).
+    Returns (mode, settings) of the highest samples/sec, from the cache when key is there.
+    """
+    key = '%s|persistent=%d' % (key, persistent)
+    cached = load_cache(cache_path).get(key)
+    if cached is not None:
+        return cached['mode'], cached['settings']
+
+    results = []
+    for mode in modes:
+        settings = dict(default_settings, pin_memory=default_settings['pin_memory'] and torch.cuda.is_available())
+        for name, values in candidates(persistent).items():
+            best = None
+            for value in values:
+                trial = dict(settings, **{name: value})
+                rate = probe(make_loader(mode, **trial), batches)
+                logger.info('loader tuning %s mode=%s %s: %.1f samples/sec' % (key, mode, trial, rate))
+                if best is None or rate > best[0]:
+                    best = (rate, value)
+            settings[name] = best[1]
+            results.append((best[0], mode, dict(settings)))
+    rate, mode, settings = max(results, key=lambda r: r[0])
+    logger.info('loader tuning %s: mode=%s %s (%.1f samples/sec)' % (key, mode, settings, rate))
+    save_cache(cache_path, key, {'mode': mode, 'settings': settings, 'samples_per_sec': rate,
+                                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    return mode, settings
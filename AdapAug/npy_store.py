@@ -0,0 +1,140 @@
+# contiguous NHWC uint8 .npy copies of the torchvision CIFAR / SVHN sets, memory-mapped read-only,
+# so every process (DataLoader workers, ray trials) shares one copy through the page cache.
+# convert once:
+#   python -m AdapAug.npy_store --dataroot /data/private/pretrainedmodels --dataset cifar10 svhn
+import argparse
+import os
+
+import numpy as np
+import torchvision
+from PIL import Image
+from torch.utils.data import Dataset
+
+# dataset name of get_dataloaders -> (torchvision name, splits)
+# SVHN 'train_extra' is train followed by extra, as used by AdapAugData
+_stores = {
+    'cifar10': ('CIFAR10', ['train', 'test']),
+    'reduced_cifar10': ('CIFAR10', ['train', 'test']),
+    'cifar100': ('CIFAR100', ['train', 'test']),
+    'svhn': ('SVHN', ['train', 'extra', 'test', 'train_extra']),
+    'reduced_svhn': ('SVHN', ['train', 'extra', 'test', 'train_extra']),
+}
+
+
+def store_path(root, dataname, split):
+    return os.path.join(root, 'npy', '%s_%s' % (dataname, split))
+
+
+def has_store(root, dataname, split):
+    path = store_path(root, dataname, split)
+    return os.path.isfile(path + '_data.npy') and os.path.isfile(path + '_labels.npy')
+
+
+def load_store(root, dataname, split):
+    """(data, labels): read-only memory maps, uint8 [N, H, W, C] and int64 [N]"""
+    path = store_path(root, dataname, split)
+    return np.load(path + '_data.npy', mmap_mode='r'), np.load(path + '_labels.npy', mmap_mode='r')
+
+
+def store_parts(root, dataname, split):
+    """number of samples of each split concatenated in the store, e.g. [train, extra]"""
+    return np.load(store_path(root, dataname, split) + '_parts.npy').tolist()
+
+
+def _torchvision_arrays(root, dataname, split):
+    if dataname == 'SVHN':
+        dataset = torchvision.datasets.SVHN(root=root, split=split, download=False)
+        return dataset.data, np.asarray(dataset.labels), True     # NCHW
+    dataset = torchvision.datasets.__dict__[dataname](root=root, train=split == 'train', download=False)
+    return dataset.data, np.asarray(dataset.targets), False
+
+
+def convert(root, dataname, split, chunk=10000):
+    parts = [_torchvision_arrays(root, dataname, s) for s in split.split('_')]
+    n = sum(len(labels) for _, labels, _ in parts)
+    data, _, nchw = parts[0]
+    shape = (n,) + (data.shape[2:] + data.shape[1:2] if nchw else data.shape[1:])
+
+    path = store_path(root, dataname, split)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to temporary files and rename, so readers never see a partial store
+    out = np.lib.format.open_memmap(path + '_data.tmp.npy', mode='w+', dtype=np.uint8, shape=shape)
+    i = 0
+    for data, _, nchw in parts:
+        for s in range(0, len(data), chunk):
+            block = data[s:s + chunk]
+            out[i:i + len(block)] = np.transpose(block, (0, 2, 3, 1)) if nchw else block
+            i += len(block)
+    out.flush()
+    del out
+    np.save(path + '_labels.tmp.npy', np.concatenate([labels for _, labels, _ in parts]).astype(np.int64))
+    np.save(path + '_parts.npy', np.array([len(labels) for _, labels, _ in parts], dtype=np.int64))
+    os.replace(path + '_data.tmp.npy', path + '_data.npy')
+    os.replace(path + '_labels.tmp.npy', path + '_labels.npy')
+    return shape
+
+
+class NpyDataset(Dataset):
+    """
+    CIFAR / SVHN split read from its memory-mapped store, with the torchvision dataset interface
+    (data, targets / labels, transform, target_transform).
+    """
+    def __init__(self, root, dataname, split, transform=None, target_transform=None):
+        self.root = root
+        self.dataname = dataname
+        self.split = split
+        self.transform = transform
+        self.target_transform = target_transform
+        self._load()
+
+    def _load(self):
+        self.data, self.targets = load_store(self.root, self.dataname, self.split)
+        self.labels = self.targets
+
+    def __getstate__(self):
+        # re-map in the receiving process instead of pickling the images
+        state = self.__dict__.copy()
+        for k in ('data', 'targets', 'labels'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        img, target = Image.fromarray(self.data[index]), int(self.targets[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+def vision_dataset(dataname, root, split, transform=None):
+    """NpyDataset when the store exists, the torchvision dataset otherwise"""
+    if has_store(root, dataname, split):
+        return NpyDataset(root, dataname, split, transform=transform)
+    if dataname == 'SVHN':
+        return torchvision.datasets.SVHN(root=root, split=split, download=False, transform=transform)
+    return torchvision.datasets.__dict__[dataname](root=root, train=split == 'train', download=False, transform=transform)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', type=str, default='/data/private/pretrainedmodels', help='torchvision data folder')
+    parser.add_argument('--dataset', type=str, nargs='+', default=['cifar10', 'cifar100', 'svhn'], choices=list(_stores))
+    args = parser.parse_args()
+
+    done = set()
+    for dataset in args.dataset:
+        dataname, splits = _stores[dataset]
+        for split in splits:
+            if (dataname, split) in done:
+                continue
+            shape = convert(args.dataroot, dataname, split)
+            done.add((dataname, split))
+            print('%s %s -> %s_data.npy %s' % (dataname, split, store_path(args.dataroot, dataname, split), shape))
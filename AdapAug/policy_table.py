@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+import torch
+
+
+class PolicyTable(object):
+    """
+    Sampled policies and log probs of every train sample in shared memory: policies
+    [N, (M,) n_subpolicy, n_op, 3] of (op id, probability id, magnitude id) as uint8,
+    log_probs [N, (M)] as float16. update() overwrites them in place, so DataLoader workers,
+    persistent ones included, read the new policies without the table being pickled again.
+    The shared generation counter is odd while update() writes and even otherwise: read()
+    retries until it got a sample from one finished generation, which it records in generation_seen.
+    """
+    def __init__(self, policies, log_probs):
+        policies, log_probs = self._check(policies, log_probs)
+        self.policies = torch.from_numpy(policies).share_memory_()
+        self.log_probs = torch.from_numpy(log_probs).share_memory_()
+        self.generation = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.generation_seen = 0    # of the last read() in this process
+
+    @staticmethod
+    def _check(policies, log_probs):
+        policies = np.asarray(policies)
+        assert policies.min() >= 0 and policies.max() < 256, "policy ids out of uint8 range"
+        return policies.astype(np.uint8), np.asarray(log_probs, dtype=np.float16)
+
+    def fits(self, policies, log_probs):
+        return tuple(self.policies.shape) == np.shape(policies) and tuple(self.log_probs.shape) == np.shape(log_probs)
+
+    def update(self, policies, log_probs):
+        policies, log_probs = self._check(policies, log_probs)
+        self.generation += 1
+        self.policies.copy_(torch.from_numpy(policies))
+        self.log_probs.copy_(torch.from_numpy(log_probs))
+        self.generation += 1
+
+    def read(self, index):
+        """(log_prob float32 [(M)], policy int64 [(M,) n_subpolicy, n_op, 3]) of sample index"""
+        while True:
+            generation = int(self.generation)
+            if generation % 2 == 0:
+                # the dtype conversions copy the row before the counter is checked again
+                log_prob = np.asarray(self.log_probs[index], dtype=np.float32)
+                policy = np.asarray(self.policies[index], dtype=np.int64)
+                if int(self.generation) == generation:
+                    self.generation_seen = generation
+                    return log_prob, policy
+            time.sleep(0)
+
+    def nbytes(self):
+        return self.policies.numel() + 2 * self.log_probs.numel()
+
+
+def store_policies(dataset, policies, log_probs):
+    """
+    Put policies / log_probs into the PolicyTable of dataset (AdapAugData), in place when the
+    shapes match, and point dataset.policies / dataset.log_probs to it.
+    """
+    table = getattr(dataset, 'policy_table', None)
+    if table is not None and table.fits(policies, log_probs):
+        table.update(policies, log_probs)
+    else:
+        dataset.policy_table = table = PolicyTable(policies, log_probs)
+    dataset.policies, dataset.log_probs = table.policies, table.log_probs
+    return table
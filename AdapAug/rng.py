@@ -0,0 +1,99 @@
+# random draws of the augmentation path.
+# by default every function below forwards to the global generator its call site used before
+# (random, np.random or torch), so nothing changes. inside keyed(seed, epoch, index, view)
+# all of them draw from one counter-based Philox stream instead: the n-th draw is a pure
+# function of (seed, epoch, index, view, stream, n), independent of worker process and scheduling.
+import contextlib
+import random as _random
+
+import numpy as np
+import torch
+
+_state = None   # (np.random.Generator, (seed, epoch, index, view, stream)) while keyed
+
+
+def _generator(seed, epoch, index, view, stream):
+    # Philox4x64: key = (seed, epoch), counter = (draw, index, view, stream)
+    return np.random.Generator(np.random.Philox(key=[seed, epoch], counter=[0, index, view, stream]))
+
+
+@contextlib.contextmanager
+def keyed(seed, epoch, index, view=0, stream=0):
+    global _state
+    prev = _state
+    _state = (_generator(seed, epoch, index, view, stream), (seed, epoch, index, view, stream))
+    try:
+        yield
+    finally:
+        _state = prev
+
+
+@contextlib.contextmanager
+def view(v):
+    """Switch to the stream of view v of the current sample. No-op when not keyed."""
+    if _state is None:
+        yield
+        return
+    with keyed(*_state[1][:3], view=v):
+        yield
+
+
+@contextlib.contextmanager
+def stream(s):
+    """Switch to sub-stream s of the current view, so its draws don't shift the others. No-op when not keyed."""
+    if _state is None:
+        yield
+        return
+    with keyed(*_state[1][:4], stream=s):
+        yield
+
+
+def is_keyed():
+    return _state is not None
+
+
+def key():
+    """(seed, epoch, index, view, stream) of the current stream, or None"""
+    return None if _state is None else _state[1]
+
+
+# python random semantics
+def random():
+    return _random.random() if _state is None else _state[0].random()
+
+
+def uniform(a, b):
+    return _random.uniform(a, b) if _state is None else a + (b - a) * _state[0].random()
+
+
+def randint(a, b):
+    # inclusive, like random.randint
+    return _random.randint(a, b) if _state is None else int(_state[0].integers(a, b + 1))
+
+
+def choice(seq):
+    return _random.choice(seq) if _state is None else seq[int(_state[0].integers(len(seq)))]
+
+
+def choices(seq, k):
+    if _state is None:
+        return _random.choices(seq, k=k)
+    return [seq[i] for i in _state[0].integers(len(seq), size=k)]
+
+
+# np.random semantics
+def np_uniform(low=0.0, high=1.0):
+    return np.random.uniform(low, high) if _state is None else low + (high - low) * _state[0].random()
+
+
+def np_randint(high):
+    return np.random.randint(high) if _state is None else int(_state[0].integers(high))
+
+
+# torch semantics (as used by torchvision's RandomCrop / RandomHorizontalFlip)
+def torch_randint(low, high):
+    return torch.randint(low, high, size=(1,)).item() if _state is None else int(_state[0].integers(low, high))
+
+
+def torch_rand():
+    return torch.rand(1).item() if _state is None else _state[0].random()
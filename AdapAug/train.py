@@ -22,7 +22,8 @@ from tqdm import tqdm
 from theconf import Config as C, ConfigArgumentParser
 
 from AdapAug.common import get_logger, EMA, add_filehandler
-from AdapAug.data import get_dataloaders, Augmentation, CutoutDefault
+from AdapAug.data import get_dataloaders, Augmentation, CutoutDefault, KeyedRNG
+from AdapAug.imagenet_shards import ShardedImageNet
 from AdapAug.lr_scheduler import adjust_learning_rate_resnet
 from AdapAug.metrics import accuracy, Accumulator, CrossEntropyLabelSmooth, Tracker
 from AdapAug.networks import get_model, num_class
@@ -37,7 +38,7 @@ logger.setLevel(logging.INFO)
 _CIFAR_MEAN, _CIFAR_STD = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
 
 def run_epoch(model, loader, loss_fn, optimizer, desc_default='', epoch=0, writer=None, verbose=1, scheduler=None, is_master=True, ema=None, wd=0.0, tqdm_disabled=False, \
-                data_parallel=False, trace=False, batch_multiplier=1, get_trace=[]):
+                data_parallel=False, trace=False, batch_multiplier=1, get_trace=[], clean_views=None):
     if data_parallel:
         model = DataParallel(model).cuda()
     if verbose:
@@ -56,13 +57,8 @@ def run_epoch(model, loader, loss_fn, optimizer, desc_default='', epoch=0, write
         steps += 1
         if isinstance(data, list):
             data, clean_data, log_prob, policy = data
-            if batch_multiplier > 1:
-                log_prob = torch.cat([ log_prob[:,m] for m in range(batch_multiplier) ]) # [batch, M] -> [batch*M]
-                policy = torch.cat([ policy[:,m] for m in range(batch_multiplier) ]) # [batch, M, n_subpolicy, n_op, 3] -> [batch*M, n_subpolicy, n_op, 3]
-        clean_label = label.detach()
-        if batch_multiplier > 1:
-            data = torch.cat([ data[:,m] for m in range(batch_multiplier) ])
-            label = label.repeat(batch_multiplier)
+        # multi-view batches come view-major: data, label, log_prob and policy are [M*batch, ...]
+        clean_label = label[:len(label) // batch_multiplier].detach()
         data, label = data.cuda(), label.cuda()
 
         if C.get().conf.get('mixup', 0.0) <= 0.0 or optimizer is None:
@@ -76,7 +72,8 @@ def run_epoch(model, loader, loss_fn, optimizer, desc_default='', epoch=0, write
 
         if 'clean_loss' in get_trace or 'clean_logits' in get_trace:
             with torch.no_grad():
-                clean_logits = model(clean_data.cuda())
+                # with clean_views, clean_data holds sample indices (also in the trace)
+                clean_logits = model((clean_data if clean_views is None else clean_views[clean_data]).cuda())
                 if 'clean_loss' in get_trace:
                     clean_loss = loss_fn(clean_logits, clean_label.cuda()).cpu().detach()
         if trace or batch_multiplier > 1:
@@ -174,7 +171,7 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
             gr_ids = m.sample().numpy()
         else:
             gr_ids = None
-        trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids)
+        trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids, draft_margin=C.get().conf.get('draft_margin', 0.), loader_tune=C.get().conf.get('loader_tune', False), resident_eval=C.get().conf.get('resident_eval', None), rng_seed=C.get().conf.get('rng_seed', None), split_cache=C.get().conf.get('split_cache', None))
     if local_rank >= 0:
         dist.init_process_group(backend='nccl', init_method='env://', world_size=int(os.environ['WORLD_SIZE']))
         device = torch.device('cuda', local_rank)
@@ -315,6 +312,8 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
     for epoch in range(epoch_start, max_epoch + 1):
         if local_rank >= 0:
             trainsampler.set_epoch(epoch)
+        if isinstance(trainloader.dataset, (KeyedRNG, ShardedImageNet)):
+            trainloader.dataset.set_epoch(epoch)
 
         model.train()
         rs = dict()
@@ -383,7 +382,7 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
 
         if gr_dist is not None:
             gr_ids = m.sample().numpy()
-            trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids)
+            trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids, draft_margin=C.get().conf.get('draft_margin', 0.), loader_tune=C.get().conf.get('loader_tune', False), resident_eval=C.get().conf.get('resident_eval', None), rng_seed=C.get().conf.get('rng_seed', None), split_cache=C.get().conf.get('split_cache', None))
     del model
 
     # result['top1_test'] = best_top1
@@ -21,7 +21,8 @@ from tqdm import tqdm
 from theconf import Config as C, ConfigArgumentParser
 
 from AdapAug.common import get_logger, EMA, add_filehandler, get_optimizer
-from AdapAug.data import get_dataloaders, Augmentation
+from AdapAug.data import get_dataloaders, Augmentation, DataModule
+from AdapAug.view_cache import ViewCache
 from AdapAug.lr_scheduler import adjust_learning_rate_resnet
 from AdapAug.metrics import accuracy, Accumulator, CrossEntropyLabelSmooth, Tracker
 from AdapAug.networks import get_model, num_class
@@ -136,7 +137,7 @@ def train_controller(controller, config):
         entropys = torch.cat(entropys)
         sampled_policies = list(torch.cat(sampled_policies).numpy()) if batch_multiplier > 1 else list(sampled_policies[0][0].numpy()) # (M, num_op, num_p, num_m)
         policies.append(sampled_policies)
-        _, total_loader, _, test_loader = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, _transform=sampled_policies, batch_multiplier=batch_multiplier)
+        _, total_loader, _, test_loader = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, _transform=sampled_policies, batch_multiplier=batch_multiplier, resident_eval=config.get('resident_eval'), rng_seed=config.get('rng_seed'), rng_epoch=epoch)
         t_net.train()
         # training and return M normalized moving averages of losses
         metrics = run_epoch(t_net, total_loader, criterion if batch_multiplier>1 else _criterion, t_optimizer, desc_default='T-train', epoch=epoch+1, scheduler=t_scheduler, wd=C.get()['optimizer']['decay'], verbose=False, \
@@ -294,7 +295,7 @@ def train_controller2(controller, config):
     # C.get()["aug"] = "clean"
     # valid_loader, default_transform, child_transform = get_post_dataloader(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, rand_val=True, childaug=childaug)
     _, _, valid_loader, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, rand_val=True, _transform=childaug)#, controller=controller)
-    _, total_loader, _, test_loader = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, _transform="default")#, controller=controller)
+    _, total_loader, _, test_loader = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, _transform="default", resident_eval=config.get('resident_eval'))#, controller=controller)
     ### Training Loop
     if ctl_train_steps is not None:
         aff_step = div_step = ctl_train_steps
@@ -309,19 +310,29 @@ def train_controller2(controller, config):
     train_metrics = {"affinity":[], "diversity": []}
     test_metrics = []
     total_t_train_time = 0.
+    aff_data = total_data = None
     for epoch in range(C.get()['epoch']):
         ## Affinity Training
         baseline = ExponentialMovingAverage(ctl_ema_weight)
         repeat = 1#len(total_loader.dataset)//len(valid_loader.dataset) if aff_step is None else 1
         for _ in range(repeat):
-            _, _, valid_loader, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, rand_val=True, controller=controller, _transform=childaug)
+            if aff_data is None:
+                aff_data = DataModule(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, rand_val=True, controller=controller, _transform=childaug, stream_policies=config.get('stream_policies', False), loader_tune=config.get('loader_tune', False), resident_eval=config.get('resident_eval'), clean_cache=config.get('clean_cache'), rng_seed=config.get('rng_seed'), split_cache=config.get('split_cache'))
+            else:
+                aff_data.set_split(cv_id)
+                aff_data.sample_policies()
+            aff_data.set_epoch(epoch)
+            valid_loader = aff_data.validloader
             a_tracker, a_metrics = run_epoch(childnet, valid_loader, criterion, None, desc_default='childnet tracking', epoch=epoch+1, verbose=False, \
                                      trace=True)
             train_metrics["affinity"].append(a_metrics.get_dict())
             controller.train()
             a_dict = a_tracker.get_dict()
+            clean_views = aff_data.trainset.clean_views
             for step, (inputs, labels) in enumerate(a_dict['clean_data']):
                 batch_size = len(labels)
+                if clean_views is not None:
+                    inputs = clean_views[inputs]
                 inputs, labels = inputs.cuda(), labels.cuda()
                 aug_loss = a_dict['loss'][step].cuda()
                 if step >= aff_loader_len - aff_train_len:
@@ -366,7 +377,12 @@ def train_controller2(controller, config):
                 logger.info(f"(Affinity)[Train Controller {epoch+1:3d}/{C.get()['epoch']:3d}] {trace['affinity'] / 'cnt'}")
         ## TargetNetwork Training
         ts = time.time()
-        _, total_loader, _, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, controller=controller, _transform="default")
+        if total_data is None:
+            total_data = DataModule(C.get()['dataset'], C.get()['batch'], config['dataroot'], 0.0, controller=controller, _transform="default", stream_policies=config.get('stream_policies', False), loader_tune=config.get('loader_tune', False), resident_eval=config.get('resident_eval'), clean_cache=config.get('clean_cache'), rng_seed=config.get('rng_seed'), split_cache=config.get('split_cache'))
+        else:
+            total_data.sample_policies()
+        total_data.set_epoch(epoch)
+        total_loader = total_data.trainloader
         t_net.train()
         t_tracker, d_metrics = run_epoch(t_net, total_loader, criterion, t_optimizer, desc_default='T-train', epoch=epoch+1, scheduler=t_scheduler, wd=C.get()['optimizer']['decay'], verbose=False, \
                                         trace=True)
@@ -377,8 +393,11 @@ def train_controller2(controller, config):
         controller.train()
         t_dict = t_tracker.get_dict()
         baseline = ExponentialMovingAverage(ctl_ema_weight)
+        clean_views = total_data.trainset.clean_views
         for step, (inputs, labels) in enumerate(t_dict['clean_data']):
             batch_size = len(labels)
+            if clean_views is not None:
+                inputs = clean_views[inputs]
             inputs, labels = inputs.cuda(), labels.cuda()
             aug_loss = t_dict['loss'][step].cuda()
             if step >= div_loader_len - div_train_len:
@@ -585,19 +604,34 @@ def train_controller3(controller, config):
     else:
         logger.info('------Train Controller from scratch------')
         train_metrics = {"affinity":[], "diversity": []}
+    view_cache = None
     ### Training Loop
     total_t_train_time = 0.
+    data_module = None
     for epoch in range(start_epoch, C.get()['epoch']):
         ## TargetNetwork Training
         ts = time.time()
-        _, total_loader, valid_loader, test_loader = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, \
-                                                     rand_val=True, controller=controller, _transform="default", validation=config['validation'], batch_multiplier=batch_multiplier)
+        if data_module is None:
+            data_module = DataModule(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, \
+                                     rand_val=True, controller=controller, _transform="default", validation=config['validation'], batch_multiplier=batch_multiplier, stream_policies=config.get('stream_policies', False), loader_tune=config.get('loader_tune', False), resident_eval=config.get('resident_eval'), clean_cache=config.get('clean_cache'), rng_seed=config.get('rng_seed'), split_cache=config.get('split_cache'))
+            if config.get('view_cache', 0) > 0:
+                # augmented views shared by all epochs and loader workers, shaped as the train images
+                view_cache = ViewCache(config['view_cache'] * 2**20, data_module.trainset.data.shape[1:])
+                data_module.set_view_cache(view_cache)
+        else:
+            data_module.set_split(cv_id)
+            data_module.sample_policies()
+        data_module.set_epoch(epoch)
+        _, total_loader, valid_loader, test_loader = data_module.loaders()
+        clean_views = data_module.trainset.clean_views
         t_net.train()
         # valid_loader = total_loader
         d_tracker, d_metrics = run_epoch(t_net, total_loader, criterion, t_optimizer, desc_default='T-train', epoch=epoch+1, scheduler=t_scheduler, wd=C.get()['optimizer']['decay'], verbose=False, \
-                                        trace=True, get_trace=['clean_loss'] if reward_type==2 else [], batch_multiplier=batch_multiplier)
+                                        trace=True, get_trace=['clean_loss'] if reward_type==2 else [], batch_multiplier=batch_multiplier, clean_views=clean_views)
         total_t_train_time += time.time() - ts
         logger.info(f"[T-train] {epoch+1}/{C.get()['epoch']} (time {total_t_train_time:.1f}) {d_metrics}")
+        if view_cache is not None:
+            logger.info(f"[view cache] {view_cache.stats()}")
         train_metrics["diversity"].append(d_metrics.get_dict())
         d_dict = d_tracker.get_dict()
         del d_tracker, d_metrics
@@ -617,7 +651,7 @@ def train_controller3(controller, config):
         # _, _, valid_loader, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['split_ratio'], split_idx=cv_id, \
         #                                         rand_val=True, controller=controller, _transform=childaug, validation=config['validation'])
         a_tracker, a_metrics = run_epoch(childnet, valid_loader, criterion, None, desc_default='childnet tracking', epoch=epoch+1, verbose=False, \
-                                        trace=True, get_trace=['logits', 'clean_logits'] if reward_type in [0,1,4] else ['clean_loss'], batch_multiplier=batch_multiplier)
+                                        trace=True, get_trace=['logits', 'clean_logits'] if reward_type in [0,1,4] else ['clean_loss'], batch_multiplier=batch_multiplier, clean_views=clean_views)
         train_metrics["affinity"].append(a_metrics.get_dict())
         a_dict = a_tracker.get_dict()
         del a_tracker, a_metrics
@@ -646,6 +680,8 @@ def train_controller3(controller, config):
                 st = time.time()
                 inputs, labels = a_dict['clean_data'][step]
                 batch_size = len(labels)*batch_multiplier
+                if clean_views is not None:
+                    inputs = clean_views[inputs]
                 inputs, labels = inputs.cuda(), labels.cuda()
                 policy = a_dict['policy'][step].cuda()
                 top1 = a_dict['acc'][step]
@@ -685,6 +721,8 @@ def train_controller3(controller, config):
                 st = time.time()
                 inputs, labels = d_dict['clean_data'][step]
                 batch_size = len(labels)*batch_multiplier
+                if clean_views is not None:
+                    inputs = clean_views[inputs]
                 inputs, labels = inputs.cuda(), labels.cuda()
                 policy = d_dict['policy'][step].cuda() # [batch*M, n_subpolicy, n_op, 3]
                 top1 = d_dict['acc'][step]
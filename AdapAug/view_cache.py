@@ -0,0 +1,123 @@
+import hashlib
+import multiprocessing
+
+import numpy as np
+import torch
+
+from AdapAug import augmentations
+
+# ops that make random draws of their own after the probability gates are resolved
+random_ops = ('Cutout', 'CutoutAbs', 'TranslateXAbs', 'TranslateYAbs')
+
+
+def cache_key(index, ops):
+    """
+    Key of the view produced by the resolved subpolicy ops (list of (name, level)) on
+    sample index: (index, canonical policy, fusion flags), or None (do not cache) when the
+    ops draw random numbers themselves. Such a view depends on the (epoch, view) draws and is
+    made once per epoch, so it could never be hit and would only evict reusable views.
+    The fusion flags of augmentations (fuse_affine, fuse_lut) change the resampling, so views
+    made under other flags are not reused.
+    """
+    if any(name in random_ops or (augmentations.random_mirror and name in augmentations.affine_dict)
+           for name, _ in ops):
+        return None
+    return (int(index), tuple((name, float(level)) for name, level in ops),
+            (augmentations.fuse_affine, augmentations.fuse_lut))
+
+
+def _encode(key):
+    return repr(key).encode()
+
+
+def _hash(encoded):
+    # stable across processes (unlike hash()), never 0 (empty slot)
+    h = int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little', signed=True)
+    return h or 1
+
+
+class ViewCache(object):
+    """
+    Cache of post-augmentation uint8 views in shared memory, so every DataLoader worker
+    reads and fills the same entries. Set associative with LRU eviction inside a set.
+    Slots hold the full key next to its hash, a lookup matches both.
+    budget: (int) bytes for the stored views and keys
+    shape: shape of one view, e.g. (32, 32, 3)
+    key_size: bytes of an encoded key, longer keys are not cached
+    """
+    def __init__(self, budget, shape, ways=8, key_size=192):
+        self.shape = tuple(shape)
+        self.key_size = key_size
+        n_slots = max(ways, budget // (int(np.prod(self.shape)) + key_size))
+        self.ways = ways
+        self.n_sets = n_slots // ways
+        n_slots = self.n_sets * ways
+        self.data = torch.zeros((n_slots,) + self.shape, dtype=torch.uint8).share_memory_()
+        self.keys = torch.zeros(n_slots, dtype=torch.int64).share_memory_()
+        self.full_keys = torch.zeros((n_slots, key_size), dtype=torch.uint8).share_memory_()
+        self.key_lens = torch.zeros(n_slots, dtype=torch.int64).share_memory_()
+        self.stamps = torch.zeros(n_slots, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(4, dtype=torch.int64).share_memory_()  # clock, hits, misses, evictions
+        self.lock = multiprocessing.Lock()
+
+    def __deepcopy__(self, memo):
+        # shared by design: copies of a dataset keep using the same cache
+        return self
+
+    def _slots(self, h):
+        s = (h % self.n_sets) * self.ways
+        return s, s + self.ways
+
+    def _find(self, s, e, h, encoded):
+        # slot of the key in the set [s, e), or None; the hash narrows, the full key decides
+        for way in np.flatnonzero(self.keys.numpy()[s:e] == h):
+            slot = s + int(way)
+            n = int(self.key_lens[slot])
+            if n == len(encoded) and self.full_keys[slot, :n].numpy().tobytes() == encoded:
+                return slot
+        return None
+
+    def get(self, key):
+        """uint8 array of the cached view, or None"""
+        encoded = _encode(key)
+        if len(encoded) > self.key_size:
+            return None
+        h = _hash(encoded)
+        s, e = self._slots(h)
+        with self.lock:
+            slot = self._find(s, e, h, encoded)
+            if slot is None:
+                self.counters[2] += 1
+                return None
+            self.counters[0] += 1
+            self.counters[1] += 1
+            self.stamps[slot] = self.counters[0]
+            return self.data[slot].numpy().copy()
+
+    def put(self, key, view):
+        encoded = _encode(key)
+        if len(encoded) > self.key_size:
+            return
+        h = _hash(encoded)
+        s, e = self._slots(h)
+        with self.lock:
+            if self._find(s, e, h, encoded) is not None:
+                return
+            slot = s + int(np.argmin(self.stamps.numpy()[s:e]))
+            if self.keys[slot] != 0:
+                self.counters[3] += 1
+            self.counters[0] += 1
+            self.data[slot].numpy()[...] = np.asarray(view).reshape(self.shape)
+            self.keys[slot] = h
+            self.full_keys[slot].numpy()[:len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+            self.key_lens[slot] = len(encoded)
+            self.stamps[slot] = self.counters[0]
+
+    def stats(self):
+        _, hits, misses, evictions = self.counters.tolist()
+        return {'hits': hits, 'misses': misses, 'evictions': evictions,
+                'entries': int((self.keys != 0).sum()), 'capacity': len(self.keys),
+                'bytes': self.data.numel() + self.full_keys.numel()}
+
+    def __len__(self):
+        return int((self.keys != 0).sum())
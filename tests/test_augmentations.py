@@ -0,0 +1,44 @@
+import numpy as np
+import PIL.Image
+import pytest
+
+from AdapAug import augmentations
+from AdapAug.view_cache import random_ops
+
+names = [fn.__name__ for fn, _, _ in augmentations.augment_list(False) if fn.__name__ not in random_ops]
+
+
+def _subpolicies(n, seed=0):
+    rs = np.random.RandomState(seed)
+    for _ in range(n):
+        ops = [(names[i], m / 10. + .1) for i, m in zip(rs.randint(len(names), size=rs.randint(1, 5)), rs.randint(10, size=4))]
+        yield ops
+
+
+@pytest.mark.parametrize('size', [(32, 32), (24, 40), (80, 72)])     # 80 x 72: img.point instead of np.take
+@pytest.mark.parametrize('fuse_lut', [False, True])
+@pytest.mark.parametrize('with_ctx', [False, True])
+def test_apply_augments_matches_unfused(monkeypatch, size, fuse_lut, with_ctx):
+    monkeypatch.setattr(augmentations, 'fuse_affine', False)
+    monkeypatch.setattr(augmentations, 'fuse_lut', fuse_lut)
+    rs = np.random.RandomState(1)
+    for ops in _subpolicies(100):
+        img = PIL.Image.fromarray(rs.randint(0, 256, size[::-1] + (3,)).astype(np.uint8))
+        ref = img
+        for name, level in ops:
+            ref = augmentations.apply_augment(ref, name, level)
+        ctx = augmentations.EnhanceContext(img) if with_ctx else None
+        out = augmentations.apply_augments(img, ops, ctx)
+        assert np.array_equal(np.asarray(out), np.asarray(ref)), ops
+
+
+def test_lut_matches_op():
+    img = PIL.Image.fromarray(np.random.RandomState(2).randint(0, 256, (16, 16, 3)).astype(np.uint8))
+    for name in augmentations.lut_dict:
+        if name == 'Contrast':
+            continue    # table per image mean, covered by test_apply_augments_matches_unfused
+        for m_id in range(10):
+            level = m_id / 10. + .1
+            lut = augmentations.get_lut(name, level)
+            expected = augmentations.apply_augment(img, name, level)
+            assert np.array_equal(np.asarray(augmentations.apply_lut(img, lut)), np.asarray(expected)), (name, m_id)
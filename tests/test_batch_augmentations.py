@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+from AdapAug import batch_augmentations
+from AdapAug.view_cache import random_ops
+
+blend_ops = ('Contrast', 'Color', 'Brightness', 'Sharpness')   # |diff| <= 1, see batch_augmentations
+
+
+def _images(shape, seed=0):
+    return torch.randint(0, 256, shape, dtype=torch.uint8, generator=torch.Generator().manual_seed(seed))
+
+
+@pytest.mark.parametrize('shape', [(8, 3, 32, 32), (4, 3, 20, 28)])
+@pytest.mark.parametrize('fn, low, high', [op for op in batch_augmentations.augment_list() if op[0].__name__ not in random_ops],
+                         ids=lambda x: getattr(x, '__name__', ''))
+def test_ops_match_pil(fn, low, high, shape):
+    imgs = _images(shape)
+    for m_id in range(10):
+        v = torch.full((len(imgs),), (m_id / 10. + .1) * (high - low) + low, dtype=torch.float64)
+        batched = batch_augmentations.run_op(fn, imgs, v, 'batch')
+        pil = batch_augmentations.run_op(fn, imgs, v, 'pil')
+        diff = (batched.int() - pil.int()).abs().max().item()
+        assert diff <= (1 if fn.__name__ in blend_ops else 0), (m_id, diff)
+
+
+def test_to_pil_round_trip():
+    for shape in [(4, 3, 8, 6), (4, 1, 8, 6)]:
+        imgs = _images(shape)
+        assert torch.equal(batch_augmentations.to_tensor(batch_augmentations.to_pil(imgs)), imgs)
+
+
+def test_auto_dispatch():
+    small, large = _images((1, 3, 32, 32)), torch.zeros((1, 3, 224, 224), dtype=torch.uint8)
+    assert batch_augmentations._batched(small, 'ShearX', 'auto')
+    assert not batch_augmentations._batched(large, 'ShearX', 'auto')
+    assert batch_augmentations._batched(large, 'Invert', 'auto')
+    assert not batch_augmentations._batched(small, 'Invert', 'pil')
+    assert batch_augmentations._batched(large, 'ShearX', 'batch')
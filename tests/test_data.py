@@ -0,0 +1,117 @@
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+from torchvision.transforms import transforms
+
+from AdapAug import data, npy_store, rng
+from AdapAug.policy_table import store_policies
+
+
+def _seed(seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+
+@pytest.mark.parametrize('cutout', [0, 16])
+@pytest.mark.parametrize('size', [(32, 32), (28, 36)])     # 28 x 36: crop window partly off the image
+def test_crop_flip_normalize_matches_compose(cutout, size):
+    mean, std = data._CIFAR_MEAN, data._CIFAR_STD
+    fused = data.CropFlipNormalize(32, 4, mean, std, cutout=cutout)
+    compose = transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std),
+    ] + ([data.CutoutDefault(cutout)] if cutout else []))
+    rs = np.random.RandomState(0)
+    for seed in range(50):
+        img = PIL.Image.fromarray(rs.randint(0, 256, size[::-1] + (3,)).astype(np.uint8))
+        _seed(seed)
+        expected = compose(img)
+        _seed(seed)
+        out = torch.full(fused.output_shape(), float('nan'))
+        assert fused(img, out=out) is out
+        assert torch.equal(out, expected), seed
+
+
+class _Targets(object):
+    def __init__(self, n, seed=0):
+        self.targets = list(np.random.RandomState(seed).randint(0, 10, n))
+
+    def __len__(self):
+        return len(self.targets)
+
+
+@pytest.mark.parametrize('dataset', ['cifar10', 'reduced_cifar10'])
+@pytest.mark.parametrize('validation', [False, True])
+@pytest.mark.parametrize('split_idx', [0, 2])
+def test_split_cache_round_trip(tmp_path, dataset, validation, split_idx):
+    trainset = _Targets(6000)
+    expected = data.split_indices(dataset, trainset, 0.2, split_idx, validation)
+    written = data.split_indices(dataset, trainset, 0.2, split_idx, validation, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    read = data.split_indices(dataset, trainset, 0.2, split_idx, validation, cache_dir=str(tmp_path))
+    assert isinstance(read[0], np.memmap)
+    for e, w, r in zip(expected, written, read):
+        if e is None:
+            assert w is None and r is None
+        else:
+            assert np.array_equal(np.asarray(w), np.asarray(e))
+            assert np.array_equal(np.asarray(r), np.asarray(e))
+            assert r.dtype == np.int64
+
+
+def _adapaug_data(root, monkeypatch, n=8, batch_multiplier=2):
+    # CIFAR10-like npy store of n random images, with controller-style policies [n, M, 5, 2, 3]
+    rs = np.random.RandomState(0)
+    arrays = (rs.randint(0, 256, (n, 32, 32, 3)).astype(np.uint8), rs.randint(0, 10, n), False)
+    monkeypatch.setattr(npy_store, '_torchvision_arrays', lambda root, dataname, split: arrays)
+    npy_store.convert(root, 'CIFAR10', 'train')
+    transform = transforms.Compose([data.CropFlipNormalize(32, 4, data._CIFAR_MEAN, data._CIFAR_STD, cutout=16)])
+    dataset = data.AdapAugData('CIFAR10', root=root, train=True, transform=transform, clean_transform=transforms.ToTensor(),
+                               batch_multiplier=batch_multiplier)
+    shape = (n, batch_multiplier, 5, 2)
+    policies = np.stack([rs.randint(len(data.op_list), size=shape), rs.randint(11, size=shape), rs.randint(10, size=shape)], -1)
+    store_policies(dataset, policies, rs.rand(n, batch_multiplier).astype(np.float32))
+    dataset.collate = True
+    return dataset
+
+
+def test_view_collate_view_major(tmp_path, monkeypatch):
+    dataset = _adapaug_data(str(tmp_path), monkeypatch)
+    keyed = data.KeyedRNG(dataset, seed=7)
+    indices = [5, 2, 7, 0]
+    (aug_img, clean, log_prob, policy), target = data.ViewCollate(keyed)([keyed[i] for i in indices])
+    M, B = dataset.batch_multiplier, len(indices)
+    assert aug_img.shape == (M * B, 3, 32, 32) and clean.shape == (B, 3, 32, 32)
+    for b, i in enumerate(indices):
+        sample_log_prob, sample_policy = dataset._policy(i)
+        with rng.keyed(7, 0, i):
+            views = dataset.augment_views(PIL.Image.fromarray(dataset.data[i]), sample_policy, i)
+        for m in range(M):
+            assert torch.equal(aug_img[m * B + b], views[m])
+            assert torch.equal(policy[m * B + b], torch.from_numpy(sample_policy[m]))
+            assert log_prob[m * B + b] == sample_log_prob[m]
+            assert target[m * B + b] == dataset.targets[i]
+
+
+def test_view_collate_deterministic_per_epoch(tmp_path, monkeypatch):
+    dataset = _adapaug_data(str(tmp_path), monkeypatch)
+    keyed = data.KeyedRNG(dataset, seed=7)
+    collate = data.ViewCollate(keyed)
+    B = 4
+
+    def views(indices):
+        return collate([keyed[i] for i in indices])[0][0].view(dataset.batch_multiplier, len(indices), 3, 32, 32)
+
+    first = views(range(B))
+    np.random.seed(1)
+    torch.manual_seed(1)
+    assert torch.equal(views(range(B)), first)      # the global RNGs play no part
+    # keyed by sample index: the same views in another batch order
+    assert torch.equal(views(range(B)[::-1]), first.flip(1))
+    keyed.set_epoch(1)
+    assert not torch.equal(views(range(B)), first)
+    keyed.set_epoch(0)
+    assert torch.equal(views(range(B)), first)